@@ -3,16 +3,17 @@
 import sys
 from collections.abc import Callable
 
-from switch import Yard, State, Action
-from tests import base_tests, problem_1_tests, problem_2_tests, problem_3_tests, debug_tests
-from search import blind_tree_search, heuristic_tree_search, heuristic_graph_search
+from switch import Yard, State, Action, UnsolvableError
+from search import blind_tree_search, heuristic_tree_search, heuristic_graph_search, external_graph_search
 from parser import parse_file
-from examples.data import \
-    yard_1, init_state_1, goal_state_1, \
-    yard_2, init_state_2, goal_state_2, \
-    yard_3, init_state_3, goal_state_3, \
-    yard_4, init_state_4, goal_state_4, \
-    yard_5, init_state_5, goal_state_5
+
+# tests and the example yards only get imported when they're asked for, so solving a file starts up faster
+# (see startup_tests in tests.py)
+
+# returns (yard, initial state, goal state) for YARD-<number>
+def load_example(number: int) -> tuple[Yard, State, State]:
+    from examples import data
+    return (getattr(data, f"yard_{number}"), getattr(data, f"init_state_{number}"), getattr(data, f"goal_state_{number}"))
 
 def print_help():
     print("Usage:")
@@ -20,8 +21,10 @@ def print_help():
     print("  python main.py blind <yard or file>")
     print("  python main.py heuristic <yard or file>")
     print("  python main.py graph <yard or file>")
+    print("  python main.py external <yard or file>")
+    print("  python main.py serve [unix socket path]")
     print()
-    print("Tests: base, test1, test2, test3, full")
+    print("Tests: base, test1, test2, test3, ranking, solvability, server, startup, plan, full")
     print("Yards: YARD-1, YARD-2, YARD-3, YARD-4, YARD-5")
     print("Files should be plaintext where the first three lines are Lisp definitions of the yard, initial state, and goal state.")
     print("See examples directory for reference!")
@@ -30,17 +33,23 @@ def print_help():
     print("Run with Python 3.12.2 or greater!")
 
 def execute_search(search: Callable[[Yard, State, State], list[Action]], yard_name: str):
+    try:
+        run_search(search, yard_name)
+    except UnsolvableError as error:
+        print(error)
+
+def run_search(search: Callable[[Yard, State, State], list[Action]], yard_name: str):
     match yard_name:
         case "YARD-1" | "yard1" | "yard-1" | "yard_1":
-            result = search(yard_1, init_state_1, goal_state_1)
+            result = search(*load_example(1))
         case "YARD-2" | "yard2" | "yard-2" | "yard_2":
-            result = search(yard_2, init_state_2, goal_state_2)
+            result = search(*load_example(2))
         case "YARD-3" | "yard3" | "yard-3" | "yard_3":
-            result = search(yard_3, init_state_3, goal_state_3)
+            result = search(*load_example(3))
         case "YARD-4" | "yard4" | "yard-4" | "yard_4":
-            result = search(yard_4, init_state_4, goal_state_4)
+            result = search(*load_example(4))
         case "YARD-5" | "yard5" | "yard-5" | "yard_5":
-            result = search(yard_5, init_state_5, goal_state_5)
+            result = search(*load_example(5))
         case _:
             yard, init_state, goal_state = parse_file(yard_name)
             if not yard or not init_state or not goal_state:
@@ -54,7 +63,11 @@ def main():
     args = sys.argv[1:]
     n = len(args)
 
-    if n == 1:
+    if n in (1, 2) and args[0] == "serve": # JSONL requests on stdin, or on a unix socket if given one
+        from server import serve
+        serve(args[1] if n == 2 else None)
+    elif n == 1:
+        from tests import base_tests, problem_1_tests, problem_2_tests, problem_3_tests, ranking_tests, solvability_tests, server_tests, startup_tests, plan_tests, debug_tests
         if args[0] == "base":
             base_tests()
         elif args[0] == "test1":
@@ -63,11 +76,26 @@ def main():
             problem_2_tests()
         elif args[0] == "test3":
             problem_3_tests()
+        elif args[0] == "ranking":
+            ranking_tests()
+        elif args[0] == "solvability":
+            solvability_tests()
+        elif args[0] == "server":
+            server_tests()
+        elif args[0] == "startup":
+            startup_tests()
+        elif args[0] == "plan":
+            plan_tests()
         elif args[0] == "full":
             base_tests()
             problem_1_tests()
             problem_2_tests()
             problem_3_tests()
+            ranking_tests()
+            solvability_tests()
+            server_tests()
+            startup_tests()
+            plan_tests()
         elif args[0] == "debug": # shhhhh
             debug_tests()
         else:
@@ -81,6 +109,8 @@ def main():
             execute_search(heuristic_tree_search, args[1])
         elif args[0] == "graph":
             execute_search(heuristic_graph_search, args[1])
+        elif args[0] == "external":
+            execute_search(external_graph_search, args[1])
     else:
         print_help()
 
@@ -0,0 +1,135 @@
+# checking and shortening plans (lists of Actions) after a search has found them
+
+from __future__ import annotations
+
+from collections import deque
+
+from switch import Yard, State, Action, expand_with_actions
+
+OPTIMIZE_WINDOW = 6 # longest stretch of a plan optimize_plan tries to replace with something shorter
+
+# r(f, t) moves the last car of f to the front of t, so moving the front car of t back to the end of f undoes it
+def inverse(action: Action) -> Action:
+    from_track, to_track = action.connection
+    return Action("l" if action.type == "r" else "r", (to_track, from_track))
+
+# every non-empty track and its cars, so two states compare equal no matter which empty tracks they know about
+def arrangement(state: State) -> tuple[tuple[int, tuple[str, ...]], ...]:
+    return tuple((track, tuple(state.get_cars_on_track(track))) for track in state.get_tracks() if state.get_cars_on_track(track))
+
+# why action can't be done in state, or None if it can
+# same rules as possible_actions: the switch has to go that way, the engine has to be on one of the tracks,
+# and there has to be a car to move
+def find_action_error(yard: Yard, state: State, action: Action) -> str | None:
+    from_track, to_track = action.connection
+    if action.type == "r":
+        if to_track not in yard.get_all_right_connections(from_track):
+            return f"there's no switch going right from {from_track} to {to_track}"
+    elif action.type == "l":
+        if to_track not in yard.get_all_left_connections(from_track):
+            return f"there's no switch going left from {from_track} to {to_track}"
+    else:
+        return f"{action.type} isn't a direction"
+    if state.get_track_with_engine() not in action.connection:
+        return f"the engine is on track {state.get_track_with_engine()}"
+    if not state.get_cars_on_track(from_track):
+        return f"track {from_track} is empty"
+    return None
+
+# why plan can't be followed from state (or doesn't end at goal_state if one is given), or None if it's fine
+# the plan is done to state itself and then undone, so state is left how it started and nothing gets copied
+def find_plan_error(yard: Yard, state: State, plan: list[Action], goal_state: State | None = None) -> str | None:
+    done = []
+    error = None
+    for i, action in enumerate(plan):
+        action_error = find_action_error(yard, state, action)
+        if action_error:
+            error = f"Action {i} {action} can't be done: {action_error}"
+            break
+        state.perform_internal_action(action)
+        done.append(action)
+    else:
+        # the hashes are kept up to date as actions are done, so they rule out almost every wrong ending for free
+        if goal_state is not None and (state.hash_value() != goal_state.hash_value() or arrangement(state) != arrangement(goal_state)):
+            error = "Plan doesn't end at the goal state"
+
+    for action in reversed(done):
+        state.perform_internal_action(inverse(action))
+    return error
+
+# find_plan_error for lots of plans from the same initial state, all replayed on one copy of it
+def validate_plans(yard: Yard, initial_state: State, plans: list[list[Action]], goal_state: State | None = None) -> list[str | None]:
+    state = State.from_state(initial_state)
+    return [find_plan_error(yard, state, plan, goal_state) for plan in plans]
+
+# cuts out every stretch of the plan that comes back to a state it was already in
+# (which includes an action right after its own inverse, or a few moves that cancel out in some other order)
+def remove_loops(initial_state: State, plan: list[Action]) -> list[Action]:
+    state = State.from_state(initial_state)
+    seen = {arrangement(state): 0} # arrangement -> how many actions of kept it takes to get there
+    kept = []
+    for action in plan:
+        state.perform_internal_action(action)
+        kept.append(action)
+        key = arrangement(state)
+        if key in seen:
+            del kept[seen[key]:]
+            seen = {key: length for key, length in seen.items() if length <= len(kept)}
+        else:
+            seen[key] = len(kept)
+    return kept
+
+# breadth first search from state out to max_depth actions
+# returns arrangement -> the actions that get there, for every state it finds
+def _paths_from(yard: Yard, state: State, max_depth: int) -> dict[tuple, list[Action]]:
+    paths = {arrangement(state): []}
+    fringe = deque([(state, [])])
+    while len(fringe) != 0:
+        current_state, path = fringe.popleft()
+        if len(path) == max_depth:
+            continue
+        for next_state, action in expand_with_actions(current_state, yard):
+            key = arrangement(next_state)
+            if key not in paths:
+                paths[key] = path + [action]
+                fringe.append((next_state, path + [action]))
+    return paths
+
+# shortens a valid plan without changing where it ends up:
+# loops get cut out, then every stretch of up to window actions is swapped for the shortest way between its ends
+# (a small search from the start of the stretch), which catches moves that could have been done in a better order
+# raises ValueError if the plan can't be followed in the first place
+def optimize_plan(yard: Yard, initial_state: State, plan: list[Action], window: int = OPTIMIZE_WINDOW) -> list[Action]:
+    error = find_plan_error(yard, State.from_state(initial_state), plan)
+    if error:
+        raise ValueError(error)
+
+    plan = remove_loops(initial_state, plan)
+    i = 0
+    state = State.from_state(initial_state)
+    while i < len(plan) - 1:
+        # where the plan is after each of the next window actions
+        ends = []
+        end_state = State.from_state(state)
+        for action in plan[i:i + window]:
+            end_state.perform_internal_action(action)
+            ends.append(arrangement(end_state))
+
+        paths = _paths_from(yard, state, min(window, len(ends)) - 1)
+        # take whichever replacement saves the most actions
+        best_saving, best_end, best_path = 0, 0, []
+        for length, key in enumerate(ends, 1):
+            if key in paths and length - len(paths[key]) > best_saving:
+                best_saving, best_end, best_path = length - len(paths[key]), length, paths[key]
+
+        if best_saving > 0:
+            plan = remove_loops(initial_state, plan[:i] + best_path + plan[i + best_end:])
+            # start over from the beginning of what changed, since the new actions might line up with earlier ones
+            i = max(0, i - window)
+            state = State.from_state(initial_state)
+            for action in plan[:i]:
+                state.perform_internal_action(action)
+        else:
+            state.perform_internal_action(plan[i])
+            i += 1
+    return plan
@@ -0,0 +1,252 @@
+# perfect hashing for yard states, plus a breadth first search that keeps almost nothing in memory
+# a state is ranked as (order of the cars reading every track left to right, how many cars are on each track)
+# so every arrangement of the cars over the tracks gets its own integer in [0, size) and nothing else does
+
+from __future__ import annotations
+
+import mmap
+import os
+import tempfile
+from array import array
+from math import comb, factorial
+from typing import Callable
+
+from switch import Yard, State, Action, SearchStopped, STOP_CHECK_INTERVAL, expand_with_actions
+
+MEMORY_MAP_THRESHOLD = 64 * 1024 * 1024 # visited sets bigger than this many bytes live in a memory mapped file
+LAYER_CHUNK_SIZE = 65_536 # how many ranks get read from / written to a layer file at once
+
+class StateRanker:
+    def __init__(self, cars: list[str], number_of_tracks: int):
+        self.cars = sorted(cars)
+        self.car_indices = {car: i for i, car in enumerate(self.cars)}
+        if len(self.car_indices) != len(self.cars):
+            raise ValueError("Cars have to be unique to be ranked")
+        self.number_of_tracks = number_of_tracks
+        self.number_of_orders = factorial(len(self.cars))
+        self.number_of_lengths = comb(len(self.cars) + number_of_tracks - 1, number_of_tracks - 1)
+        self.size = self.number_of_orders * self.number_of_lengths
+
+    # makes a ranker big enough for the cars in initial_state and every track in the yard or either state
+    @staticmethod
+    def for_problem(yard: Yard, initial_state: State, goal_state: State) -> StateRanker:
+        tracks = set(initial_state.get_tracks()) | set(goal_state.get_tracks()) | yard.get_tracks()
+        cars = [car for track in initial_state.get_tracks() for car in initial_state.get_cars_on_track(track)]
+        return StateRanker(cars, max(tracks, default = 1))
+
+    def rank(self, state: State) -> int:
+        order = []
+        lengths = []
+        for track in range(1, self.number_of_tracks + 1):
+            cars = state.get_cars_on_track(track)
+            order.extend(cars)
+            lengths.append(len(cars))
+        if len(order) != len(self.cars) or any(track > self.number_of_tracks for track in state.get_tracks() if state.get_cars_on_track(track)):
+            raise ValueError("State doesn't have the same cars or tracks as this ranker")
+        return self._rank_order(order) * self.number_of_lengths + self._rank_lengths(lengths)
+
+    def unrank(self, rank: int) -> State:
+        order = self._unrank_order(rank // self.number_of_lengths)
+        lengths = self._unrank_lengths(rank % self.number_of_lengths)
+        state = []
+        position = 0
+        for length in lengths:
+            state.append(order[position:position + length])
+            position += length
+        return State(state)
+
+    # Lehmer code: for each car, how many cars that haven't been used yet come before it alphabetically
+    def _rank_order(self, order: list[str]) -> int:
+        unused = list(range(len(self.cars)))
+        rank = 0
+        for i, car in enumerate(order):
+            if car not in self.car_indices:
+                raise ValueError(f"Car {car} isn't one of this ranker's cars")
+            digit = unused.index(self.car_indices[car]) # raises ValueError if a car shows up twice
+            unused.pop(digit)
+            rank += digit * factorial(len(order) - 1 - i)
+        return rank
+
+    def _unrank_order(self, rank: int) -> list[str]:
+        unused = list(range(len(self.cars)))
+        order = []
+        for i in range(len(self.cars)):
+            place_value = factorial(len(self.cars) - 1 - i)
+            order.append(self.cars[unused.pop(rank // place_value)])
+            rank %= place_value
+        return order
+
+    # track lengths are stars and bars: the bars between tracks sit at positions p_1 < p_2 < ... in n + tracks - 1 slots,
+    # which the combinatorial number system ranks as sum of comb(p_j, j)
+    def _rank_lengths(self, lengths: list[int]) -> int:
+        rank = 0
+        position = -1
+        for j, length in enumerate(lengths[:-1], 1):
+            position += length + 1
+            rank += comb(position, j)
+        return rank
+
+    def _unrank_lengths(self, rank: int) -> list[int]:
+        positions = []
+        for j in range(self.number_of_tracks - 1, 0, -1): # biggest bar first, as far right as it can go
+            position = j - 1
+            while comb(position + 1, j) <= rank:
+                position += 1
+            positions.append(position)
+            rank -= comb(position, j)
+        positions.reverse()
+
+        lengths = []
+        previous = -1
+        for position in positions:
+            lengths.append(position - previous - 1)
+            previous = position
+        lengths.append(len(self.cars) + self.number_of_tracks - 2 - previous)
+        return lengths
+
+# one bit per state rank
+# small ones are a bytearray, big ones are a memory mapped (sparse) temporary file so the OS can page them out
+class VisitedSet:
+    def __init__(self, size: int, directory: str | None = None):
+        self.size = size
+        number_of_bytes = max(1, (size + 7) // 8)
+        self.file = None
+        if number_of_bytes > MEMORY_MAP_THRESHOLD:
+            self.file = tempfile.TemporaryFile(dir = directory)
+            self.file.truncate(number_of_bytes)
+            self.bits = mmap.mmap(self.file.fileno(), number_of_bytes)
+        else:
+            self.bits = bytearray(number_of_bytes)
+
+    def __contains__(self, rank: int) -> bool:
+        return bool(self.bits[rank >> 3] & (1 << (rank & 7)))
+
+    # marks rank as visited, returning whether it was new
+    def add(self, rank: int) -> bool:
+        byte = self.bits[rank >> 3]
+        bit = 1 << (rank & 7)
+        if byte & bit:
+            return False
+        self.bits[rank >> 3] = byte | bit
+        return True
+
+    def close(self):
+        if self.file:
+            self.bits.close() # pyright: ignore[reportAttributeAccessIssue]
+            self.file.close()
+
+# breadth first search over ranks that only keeps the current layer and a VisitedSet, for problems small enough to search in full
+# returns how many actions the shortest plan takes, or None if the goal can't be reached at all
+def shortest_plan_length(yard: Yard, initial_state: State, goal_state: State, stop: Callable[[], bool] | None = None) -> int | None:
+    ranker = StateRanker.for_problem(yard, initial_state, goal_state)
+    try:
+        goal_rank = ranker.rank(goal_state)
+    except ValueError:
+        return None
+    layer = [ranker.rank(initial_state)]
+    visited = VisitedSet(ranker.size)
+    visited.add(layer[0])
+    depth = 0
+    nodes_expanded = 0
+    try:
+        while layer:
+            if goal_rank in visited:
+                return depth
+            next_layer = []
+            for rank in layer:
+                nodes_expanded += 1
+                if stop and nodes_expanded % STOP_CHECK_INTERVAL == 0 and stop():
+                    raise SearchStopped()
+                for state, _ in expand_with_actions(ranker.unrank(rank), yard):
+                    child_rank = ranker.rank(state)
+                    if visited.add(child_rank):
+                        next_layer.append(child_rank)
+            layer = next_layer
+            depth += 1
+        return None
+    finally:
+        visited.close()
+
+def _read_layer(path: str):
+    with open(path, "rb") as file:
+        while True:
+            chunk = array("Q")
+            try:
+                chunk.fromfile(file, LAYER_CHUNK_SIZE)
+            except EOFError: # last chunk is short, but fromfile still keeps what it read
+                pass
+            if len(chunk) == 0:
+                return
+            yield from chunk
+
+# breadth first search where each layer of the frontier is a file of ranks on disk and duplicates are caught by a VisitedSet
+# so memory use is one bit per possible state instead of a python object per visited state
+# returns (plan, nodes_expanded); plan is None if the goal can't be reached at all, which is then proven
+def external_bfs(
+    yard: Yard,
+    initial_state: State,
+    goal_state: State,
+    directory: str | None = None,
+    stop: Callable[[], bool] | None = None
+) -> tuple[list[Action] | None, int]:
+    ranker = StateRanker.for_problem(yard, initial_state, goal_state)
+    if ranker.size >= 1 << 64:
+        raise ValueError("State space is too big to rank into 64 bits")
+    try:
+        goal_rank = ranker.rank(goal_state)
+    except ValueError: # goal has different cars, so it definitely can't be reached
+        return (None, 0)
+    initial_rank = ranker.rank(initial_state)
+    if initial_rank == goal_rank:
+        return ([], 0)
+
+    nodes_expanded = 0
+    visited = VisitedSet(ranker.size, directory)
+    with tempfile.TemporaryDirectory(dir = directory) as layer_directory:
+        layer_paths = [os.path.join(layer_directory, "layer-0")]
+        with open(layer_paths[0], "wb") as file:
+            array("Q", [initial_rank]).tofile(file)
+        visited.add(initial_rank)
+
+        found = False
+        while not found:
+            next_layer_path = os.path.join(layer_directory, f"layer-{len(layer_paths)}")
+            next_layer_size = 0
+            with open(next_layer_path, "wb") as file:
+                buffer = array("Q")
+                for rank in _read_layer(layer_paths[-1]):
+                    nodes_expanded += 1
+                    if stop and nodes_expanded % STOP_CHECK_INTERVAL == 0 and stop():
+                        visited.close()
+                        raise SearchStopped()
+                    for state, _ in expand_with_actions(ranker.unrank(rank), yard):
+                        child_rank = ranker.rank(state)
+                        if visited.add(child_rank):
+                            buffer.append(child_rank)
+                            found = found or child_rank == goal_rank
+                    if len(buffer) >= LAYER_CHUNK_SIZE:
+                        buffer.tofile(file)
+                        next_layer_size += len(buffer)
+                        buffer = array("Q")
+                    if found:
+                        break
+                buffer.tofile(file)
+                next_layer_size += len(buffer)
+            layer_paths.append(next_layer_path)
+
+            if next_layer_size == 0: # ran out of new states without seeing the goal
+                visited.close()
+                return (None, nodes_expanded)
+        visited.close()
+
+        # walk back through the layers, finding a parent of the current state in each one
+        actions = []
+        target_rank = goal_rank
+        for layer_path in reversed(layer_paths[:-1]):
+            for rank in _read_layer(layer_path):
+                action = next((action for child, action in expand_with_actions(ranker.unrank(rank), yard) if ranker.rank(child) == target_rank), None)
+                if action:
+                    actions.insert(0, action)
+                    target_rank = rank
+                    break
+        return (actions, nodes_expanded)
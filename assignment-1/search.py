@@ -5,7 +5,8 @@ from collections import deque
 from typing import Callable
 from time import perf_counter
 
-from switch import Yard, State, Action, expand_with_actions
+from switch import Yard, State, Action, SearchStopped, STOP_CHECK_INTERVAL, expand_with_actions, check_solvable
+from ranking import external_bfs
 
 # node contains the current State, the previous State / Node, the action that took it from the previous state to this one,
 # and the depth this node is at in the search tree
@@ -25,7 +26,8 @@ def backtrack_actions_through_tree(node: Node) -> list[Action]:
         node = node.parent_node
     return actions
 
-def dfs(yard: Yard, initial_state: State, goal_state: State, depth_limit: int) -> tuple[Node | None, int]:
+# all the searches take an optional stop callback so a caller can time out or cancel them (see switch.SearchStopped)
+def dfs(yard: Yard, initial_state: State, goal_state: State, depth_limit: int, stop: Callable[[], bool] | None = None) -> tuple[Node | None, int]:
     nodes_expanded = 1
     fringe = deque([Node(initial_state)]) # we use a deque instead of a list cause it's faster
     while len(fringe) != 0: # while we still have states to process,
@@ -36,6 +38,8 @@ def dfs(yard: Yard, initial_state: State, goal_state: State, depth_limit: int) -
             continue
         next_actions = expand_with_actions(node.state, yard) # otherwise get the next states we can go to
         nodes_expanded += 1
+        if stop and nodes_expanded % STOP_CHECK_INTERVAL == 0 and stop():
+            raise SearchStopped()
         for state, action in next_actions: # add them to the fringe, increasing the depth by 1
             fringe.append(Node(state, node, action, node.depth + 1))
     return (None, nodes_expanded) # if we exhausted the fringe, we couldn't find a solution...
@@ -45,9 +49,11 @@ def dfs(yard: Yard, initial_state: State, goal_state: State, depth_limit: int) -
 # originally this was number of cars - number of cars on track 1 which is faster, but I think you might test on alternative end goals...
 def f_factory(goal_state: State) -> Callable[[Node], int]:
     number_of_cars = goal_state.count_number_of_cars()
-    return lambda node: node.depth + (number_of_cars - State.number_of_cars_on_correct_track(node.state, goal_state))
+    # correct_cars is cached on each state and updated per Action, so this doesn't rescan every car
+    return lambda node: node.depth + (number_of_cars - node.state.correct_cars(goal_state))
 
-def dijkstras(yard: Yard, initial_state: State, goal_state: State) -> tuple[Node | None, int]:
+# nodes deeper than depth_limit aren't expanded, which keeps the tree finite when there's no plan
+def dijkstras(yard: Yard, initial_state: State, goal_state: State, depth_limit: int | None = None, stop: Callable[[], bool] | None = None) -> tuple[Node | None, int]:
     # make our f(n) cost function
     f = f_factory(goal_state)
 
@@ -64,14 +70,18 @@ def dijkstras(yard: Yard, initial_state: State, goal_state: State) -> tuple[Node
         node = heappop(fringe)
         if node.state == goal_state: # if the current state is a goal state, we're done!
             return (node, nodes_expanded)
+        elif depth_limit is not None and node.depth >= depth_limit: # children would be too deep to be on a shortest plan
+            continue
         next_actions = expand_with_actions(node.state, yard) # otherwise get the next states we can go to
         nodes_expanded += 1
+        if stop and nodes_expanded % STOP_CHECK_INTERVAL == 0 and stop():
+            raise SearchStopped()
         for state, action in next_actions:
             child_node = ComparisonNode(state, node, action, node.depth + 1)
             heappush(fringe, child_node) # add them to the fringe, increasing the depth by 1
     return (None, nodes_expanded) # if we exhausted the fringe, we couldn't find a solution...
 
-def graph_search(yard: Yard, initial_state: State, goal_state: State) -> tuple[Node | None, int]:
+def graph_search(yard: Yard, initial_state: State, goal_state: State, stop: Callable[[], bool] | None = None) -> tuple[Node | None, int]:
     # this is almost identical to dijkstras except we keep track of visited states with a set
     f = f_factory(goal_state)
 
@@ -88,28 +98,32 @@ def graph_search(yard: Yard, initial_state: State, goal_state: State) -> tuple[N
         node = heappop(fringe)
         if node.state == goal_state:
             return (node, nodes_expanded)
-        state_representation = str(node.state) # we have to use this intermediary representation cause python can't hash dicts
-        if not state_representation in closed:
-            closed.add(state_representation) # if we're checking out a new state, add it to the closed set
+        if not node.state in closed: # States hash with their Zobrist hash, so they can go straight in the set
+            closed.add(node.state) # if we're checking out a new state, add it to the closed set
             next_actions = expand_with_actions(node.state, yard)
             nodes_expanded += 1
+            if stop and nodes_expanded % STOP_CHECK_INTERVAL == 0 and stop():
+                raise SearchStopped()
             for state, action in next_actions:
                 child_node = ComparisonNode(state, node, action, node.depth + 1)
                 heappush(fringe, child_node)
     return (None, nodes_expanded)
 
 # we use iterative deepening (see PDF writeup for further details)
+# every search checks the problem with check_solvable first, which raises UnsolvableError on impossible problems
+# and otherwise says how long the shortest plan can be
 def blind_tree_search(yard: Yard, initial_state: State, goal_state: State, report_depth = True) -> list[Action]:
-    depth_limit = 0
+    max_plan_length = check_solvable(yard, initial_state, goal_state) # no point deepening past the longest a shortest plan could be
 
     start_time = perf_counter()
-    while True: # forever,
+    for depth_limit in range(max(max_plan_length, 1)): # depth_limit finds plans up to depth_limit + 1 long
         if report_depth:
             print(f"Checking with depth limit {depth_limit + 1}...")
         result, nodes_expanded = dfs(yard, initial_state, goal_state, depth_limit) # do dfs at this depth
         if result: # if we found a result, yay!
             break
-        depth_limit += 1 # otherwise increase the depth by one and retry
+    else: # otherwise increase the depth by one and retry, until we pass the bound
+        raise Exception(f"Iterative deepening found no path up to the plan length bound {max_plan_length}")
     end_time = perf_counter()
     
     print(f"Found a solution with {nodes_expanded} expansions taking {round(end_time - start_time, 6)} seconds!")
@@ -118,8 +132,9 @@ def blind_tree_search(yard: Yard, initial_state: State, goal_state: State, repor
 # I think heuristic_tree_search and heuristic_graph_search are pretty self explanatory, no?
 
 def heuristic_tree_search(yard: Yard, initial_state: State, goal_state: State) -> list[Action]:
+    max_plan_length = check_solvable(yard, initial_state, goal_state)
     start_time = perf_counter()
-    result, nodes_expanded = dijkstras(yard, initial_state, goal_state)
+    result, nodes_expanded = dijkstras(yard, initial_state, goal_state, max_plan_length)
     end_time = perf_counter()
 
     if not result:
@@ -129,6 +144,7 @@ def heuristic_tree_search(yard: Yard, initial_state: State, goal_state: State) -
     return backtrack_actions_through_tree(result)
 
 def heuristic_graph_search(yard: Yard, initial_state: State, goal_state: State) -> list[Action]:
+    check_solvable(yard, initial_state, goal_state)
     start_time = perf_counter()
     result, nodes_expaned = graph_search(yard, initial_state, goal_state)
     end_time = perf_counter()
@@ -138,3 +154,48 @@ def heuristic_graph_search(yard: Yard, initial_state: State, goal_state: State)
 
     print(f"Found a solution with {nodes_expaned} expansions taking {round(end_time - start_time, 6)} seconds!")
     return backtrack_actions_through_tree(result)
+
+# breadth first search with ranked states, a bit-packed visited set and frontier layers on disk (see ranking.py)
+# slower than the others on small yards, but it works on state spaces that don't fit in memory and can prove there's no plan
+def external_graph_search(yard: Yard, initial_state: State, goal_state: State) -> list[Action]:
+    check_solvable(yard, initial_state, goal_state)
+    start_time = perf_counter()
+    result, nodes_expanded = external_bfs(yard, initial_state, goal_state)
+    end_time = perf_counter()
+
+    if result is None:
+        raise Exception(f"Exhaustive search proved there is no path ({nodes_expanded} expansions)")
+
+    print(f"Found a solution with {nodes_expanded} expansions taking {round(end_time - start_time, 6)} seconds!")
+    return result
+
+SOLVE_METHODS = ("blind", "heuristic", "graph", "external")
+
+# runs one of the searches quietly and returns (plan, nodes_expanded), for callers that don't want printing (i.e. server.py)
+# raises UnsolvableError if the problem is rejected up front, SearchStopped if stop() said to, or Exception if nothing was found
+def solve(yard: Yard, initial_state: State, goal_state: State, method: str = "graph", stop: Callable[[], bool] | None = None) -> tuple[list[Action], int]:
+    max_plan_length = check_solvable(yard, initial_state, goal_state, stop)
+    if method == "blind":
+        total_nodes_expanded = 0
+        for depth_limit in range(max(max_plan_length, 1)):
+            result, nodes_expanded = dfs(yard, initial_state, goal_state, depth_limit, stop)
+            total_nodes_expanded += nodes_expanded
+            if result:
+                return (backtrack_actions_through_tree(result), total_nodes_expanded)
+        raise Exception("Iterative deepening found no path up to the plan length bound")
+    elif method == "heuristic":
+        result, nodes_expanded = dijkstras(yard, initial_state, goal_state, max_plan_length, stop)
+    elif method == "graph":
+        result, nodes_expanded = graph_search(yard, initial_state, goal_state, stop)
+    elif method == "external":
+        plan, nodes_expanded = external_bfs(yard, initial_state, goal_state, stop = stop)
+        if plan is None:
+            raise Exception("Exhaustive search proved there is no path")
+        return (plan, nodes_expanded)
+    else:
+        raise ValueError(f"Invalid search method {method}")
+
+    if not result:
+        raise Exception(f"{method} search failed to find a path")
+    return (backtrack_actions_through_tree(result), nodes_expanded)
+
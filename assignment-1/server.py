@@ -0,0 +1,266 @@
+# keeps the solver resident so lots of small solves don't each pay for interpreter startup, imports, and parsing
+# requests are one JSON object per line, on stdin or a unix socket:
+#   {"id": 1, "yard": "((1 2) (1 3))", "init": "((*) (a) empty)", "goal": "((* a) empty empty)", "method": "graph", "timeout": 5}
+#   {"id": 2, "name": "YARD-2", "method": "heuristic"}
+#   {"cancel": 1}
+# and every request gets exactly one JSON line back, in whatever order they finish:
+#   {"id": 1, "plan": [["r", [2, 1]]], "nodes_expanded": 3, "seconds": 0.0001, "cached": false}
+#   {"id": 2, "error": "timeout"}
+# method is one of blind, heuristic, graph, external (default graph), timeout is in seconds (default DEFAULT_TIMEOUT)
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Array
+from time import perf_counter, time
+
+from switch import Yard, State, UnsolvableError, SearchStopped
+from search import solve, SOLVE_METHODS
+from parser import parse_yard, parse_state
+
+DEFAULT_TIMEOUT = 60 # seconds
+SOLUTION_CACHE_SIZE = 4_096 # solved problems remembered per process
+PARSE_CACHE_SIZE = 1_024 # parsed yards and states remembered per process
+CANCEL_SLOTS = 1_024 # most requests that can be running or queued at once
+
+# per worker process, these live for as long as the pool does
+_yards: OrderedDict[str, Yard] = OrderedDict()
+_states: OrderedDict[str, State] = OrderedDict()
+_solutions: OrderedDict[tuple[str, str, str, str], dict] = OrderedDict()
+_cancelled = None
+
+def _initialize_worker(cancelled):
+    global _cancelled
+    _cancelled = cancelled
+
+def _get_yard(yard_string: str) -> Yard:
+    if yard_string in _yards:
+        _yards.move_to_end(yard_string)
+        return _yards[yard_string]
+    yard = parse_yard(yard_string)
+    if yard is None:
+        raise ValueError(f"Invalid yard {yard_string}")
+    _remember(_yards, yard_string, yard, PARSE_CACHE_SIZE)
+    return yard
+
+def _get_state(state_string: str) -> State:
+    if state_string in _states:
+        _states.move_to_end(state_string)
+        return _states[state_string]
+    state = parse_state(state_string)
+    _remember(_states, state_string, state, PARSE_CACHE_SIZE)
+    return state
+
+def _remember(cache: OrderedDict, key, value, size: int = SOLUTION_CACHE_SIZE):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > size:
+        cache.popitem(last = False)
+
+# runs in a worker process; deadline is wall clock time since perf_counter doesn't agree between processes
+def _solve_in_worker(yard_string: str, init_string: str, goal_string: str, method: str, deadline: float, slot: int) -> dict:
+    key = (yard_string, init_string, goal_string, method)
+    if key in _solutions:
+        _solutions.move_to_end(key)
+        return {**_solutions[key], "cached": True}
+
+    start = perf_counter()
+    local_deadline = start + (deadline - time())
+    def stop() -> bool:
+        return perf_counter() > local_deadline or bool(_cancelled is not None and _cancelled[slot])
+
+    try:
+        yard = _get_yard(yard_string)
+        plan, nodes_expanded = solve(yard, _get_state(init_string), _get_state(goal_string), method, stop)
+    except SearchStopped:
+        return {"error": "cancelled" if _cancelled is not None and _cancelled[slot] else "timeout"}
+    except UnsolvableError as error:
+        result = {"error": str(error)}
+    except Exception as error:
+        return {"error": str(error)}
+    else:
+        result = {
+            "plan": [[action.type, list(action.connection)] for action in plan],
+            "nodes_expanded": nodes_expanded,
+            "seconds": perf_counter() - start
+        }
+    _remember(_solutions, key, result) # unsolvable answers are worth caching too
+    return {**result, "cached": False}
+
+class SolveServer:
+    def __init__(self, workers: int | None = None):
+        self.cancelled = Array("b", CANCEL_SLOTS, lock = False)
+        self.workers = workers
+        self.pool = self._new_pool()
+        self.free_slots = list(range(CANCEL_SLOTS - 1, -1, -1))
+        self.running: dict[int, tuple] = {} # internal key -> (request id, future, slot), since ids are only echoed back
+        self.next_key = 0
+        self.solutions: OrderedDict[tuple[str, str, str, str], dict] = OrderedDict() # so repeats don't even go to a worker
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.workers, initializer = _initialize_worker, initargs = (self.cancelled,))
+
+    # a worker dying breaks the whole pool, so the first request to notice swaps in a new one
+    def _replace_pool(self, broken_pool: ProcessPoolExecutor):
+        if self.pool is broken_pool:
+            broken_pool.shutdown(wait = False, cancel_futures = True)
+            self.pool = self._new_pool()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures = True)
+
+    # handles one request line, returning the response object (or None for a cancel, which has no response of its own)
+    async def handle(self, line: str) -> dict | None:
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Request has to be a JSON object")
+        except ValueError as error:
+            return {"id": None, "error": f"Bad request: {error}"}
+
+        if "cancel" in request:
+            self.cancel(request["cancel"])
+            return None
+
+        request_id = request.get("id")
+        try:
+            yard_string, init_string, goal_string = self._problem_strings(request)
+            for name, value in (("yard", yard_string), ("init", init_string), ("goal", goal_string)):
+                if not isinstance(value, str):
+                    raise ValueError(f"{name} has to be a string")
+            method = request.get("method", "graph")
+            if method not in SOLVE_METHODS:
+                raise ValueError(f"method has to be one of {', '.join(SOLVE_METHODS)}")
+            timeout = request.get("timeout", DEFAULT_TIMEOUT)
+            if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout != timeout:
+                raise ValueError("timeout has to be a number of seconds")
+        except (KeyError, TypeError, ValueError) as error:
+            return {"id": request_id, "error": f"Bad request: {error}"}
+
+        key = (yard_string, init_string, goal_string, method)
+        if key in self.solutions:
+            self.solutions.move_to_end(key)
+            return {"id": request_id, **self.solutions[key], "cached": True}
+        if not self.free_slots:
+            return {"id": request_id, "error": "Too many requests in flight"}
+
+        slot = self.free_slots.pop()
+        self.cancelled[slot] = 0
+        pool = self.pool
+        try:
+            future: Future = pool.submit(_solve_in_worker, yard_string, init_string, goal_string, method, time() + timeout, slot)
+        except BrokenProcessPool:
+            self._replace_pool(pool)
+            pool = self.pool
+            future = pool.submit(_solve_in_worker, yard_string, init_string, goal_string, method, time() + timeout, slot)
+        running_key = self.next_key
+        self.next_key += 1
+        self.running[running_key] = (request_id, future, slot)
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            result = {"error": "cancelled"}
+        except Exception as error: # i.e. the worker died, which says nothing about the problem so it isn't cached
+            if isinstance(error, BrokenProcessPool):
+                self._replace_pool(pool)
+            return {"id": request_id, "error": f"Worker failed: {error}"}
+        finally:
+            del self.running[running_key]
+            self.free_slots.append(slot)
+
+        if result.get("error") not in ("timeout", "cancelled"):
+            _remember(self.solutions, key, {k: v for k, v in result.items() if k != "cached"})
+        return {"id": request_id, **result}
+
+    # a queued request is just dropped, a running one gets its flag set and the search notices on its next check
+    # every request in flight with that id is cancelled, and requests without an id can't be
+    def cancel(self, request_id):
+        if request_id is None:
+            return
+        for running_id, future, slot in self.running.values():
+            if running_id == request_id and not future.cancel():
+                self.cancelled[slot] = 1
+
+    @staticmethod
+    def _problem_strings(request: dict) -> tuple[str, str, str]:
+        if "name" in request:
+            return _named_problem(str(request["name"]))
+        return (request["yard"], request["init"], request["goal"])
+
+# the example yards, read as the strings the parser would see so they share the same cache keys as everything else
+EXAMPLES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+def _named_problem(name: str) -> tuple[str, str, str]:
+    number = name.upper().replace("_", "-").removeprefix("YARD-").removeprefix("YARD")
+    if not number.isdigit():
+        raise ValueError(f"Unknown yard {name}")
+    path = os.path.join(EXAMPLES_DIRECTORY, f"yard{number}.txt")
+    if not os.path.exists(path):
+        raise ValueError(f"Unknown yard {name}")
+    with open(path) as file:
+        lines = [line.rstrip() for line in file]
+    if len(lines) < 3:
+        raise ValueError(f"Invalid file {path}")
+    return (lines[0], lines[1], lines[2])
+
+async def serve_stdin(server: SolveServer):
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def respond(line: str):
+        response = await server.handle(line)
+        if response is not None:
+            sys.stdout.write(json.dumps(response) + "\n")
+            sys.stdout.flush()
+
+    # stdin is read on a thread since it might be a file or a terminal, which the event loop can't watch
+    while line := await loop.run_in_executor(None, sys.stdin.readline):
+        if line.strip():
+            task = asyncio.create_task(respond(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    if tasks: # stdin closed, but still answer everything that was asked
+        await asyncio.wait(tasks)
+
+async def serve_socket(server: SolveServer, path: str):
+    async def connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = set()
+
+        async def respond(line: str):
+            response = await server.handle(line)
+            if response is not None and not writer.is_closing():
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+
+        while line := await reader.readline():
+            if line.strip():
+                task = asyncio.create_task(respond(line.decode()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+        writer.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+    unix_server = await asyncio.start_unix_server(connection, path)
+    async with unix_server:
+        await unix_server.serve_forever()
+
+def serve(socket_path: str | None = None, workers: int | None = None):
+    server = SolveServer(workers)
+    try:
+        if socket_path:
+            asyncio.run(serve_socket(server, socket_path))
+        else:
+            asyncio.run(serve_stdin(server))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
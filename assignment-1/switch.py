@@ -1,7 +1,40 @@
 from __future__ import annotations # this has to be the first line, otherwise you can't do recursive type hinting
 
-from collections import defaultdict
-from typing import Literal
+from collections import Counter, defaultdict, deque
+from math import comb, factorial
+from random import Random
+from typing import Callable, Literal
+
+# Zobrist-style state hashing
+# each track gets a polynomial hash of its cars (sum of car_key * HASH_BASE^position), which can be updated in O(1)
+# when a car comes off or goes onto either end, and a state's hash is the sum of track_key * track_hash over its tracks
+# so an Action only has to touch the two tracks it moves a car between
+HASH_MODULUS = (1 << 61) - 1 # Mersenne prime
+HASH_BASE = 1_000_003
+HASH_BASE_INVERSE = pow(HASH_BASE, -1, HASH_MODULUS)
+
+_hash_random = Random(681) # fixed seed so hashes are the same every run
+_car_keys: dict[str, int] = {}
+_track_keys: dict[int, int] = {}
+_base_powers = [1] # _base_powers[i] = HASH_BASE^i
+
+def _car_key(car: str) -> int:
+    if car not in _car_keys:
+        _car_keys[car] = _hash_random.randrange(1, HASH_MODULUS)
+    return _car_keys[car]
+
+def _track_key(track: int) -> int:
+    if track not in _track_keys:
+        _track_keys[track] = _hash_random.randrange(1, HASH_MODULUS)
+    return _track_keys[track]
+
+def _base_power(i: int) -> int:
+    while len(_base_powers) <= i:
+        _base_powers.append(_base_powers[-1] * HASH_BASE % HASH_MODULUS)
+    return _base_powers[i]
+
+def _hash_track(cars: list[str]) -> int:
+    return sum(_car_key(car) * _base_power(i) for i, car in enumerate(cars)) % HASH_MODULUS
 
 class Yard:
     # dict[track, set[track]] is an easy way to represent graphs
@@ -24,35 +57,73 @@ class Yard:
     def get_all_left_connections(self, track: int) -> set[int]:
         return self._left_switches[track]
 
+    # returns every track that has at least one switch
+    def get_tracks(self) -> set[int]:
+        return {track for track, others in self._right_switches.items() if others} | {track for track, others in self._left_switches.items() if others}
+
 class State:
     def __init__(self, state: list[list[str]]):
-        self._data = defaultdict(list)
+        self._tracks = defaultdict(list)
         for i, cars in enumerate(state):
             track = i + 1 # track indexing starts at 1, not 0
-            self._data[track].extend(cars) # add ordered cars on that track to internal data structure
+            self._tracks[track].extend(cars) # add ordered cars on that track to internal data structure
+        self.invalidate()
+
+    # the cached values below get updated by perform_internal_action; anything else that changes the cars has to
+    # go through the _data setter or call invalidate() so they get recomputed from scratch
+    def invalidate(self):
+        self._hash = None # Zobrist-style hash of the whole state
+        self._track_hashes = None # track -> hash of the cars on that track
+        self._engine_track = None
+        self._goal = None # the goal state _correct_cars was counted against
+        self._correct_cars = 0 # State.number_of_cars_on_correct_track(self, self._goal)
+        self._goal_counts = None # (car, track) -> how many of that car go there, used when this state is somebody's goal
+
+    @property
+    def _data(self) -> defaultdict[int, list[str]]:
+        return self._tracks
+
+    @_data.setter
+    def _data(self, data: defaultdict[int, list[str]]):
+        self._tracks = data
+        self.invalidate()
     
     # returns a new state that's a deep copy of the passed state
     # Python constructor overloading isn't that good so this has to be a static method
     @staticmethod
     def from_state(state: State) -> State:
         new_state = State([])
-        new_state._data = defaultdict(list)
-        for key, value in state._data.items(): # can't just shallow copy it, gotta do it the long way
-            new_state._data[key] = [x for x in value]
+        for key, value in state._tracks.items(): # can't just shallow copy it, gotta do it the long way
+            new_state._tracks[key] = [x for x in value]
+        # the caches carry over too so the new state doesn't have to recompute them
+        new_state._hash = state._hash
+        new_state._track_hashes = dict(state._track_hashes) if state._track_hashes is not None else None
+        new_state._engine_track = state._engine_track
+        new_state._goal = state._goal
+        new_state._correct_cars = state._correct_cars
         return new_state
     
     def __repr__(self) -> str:
-        return str(self._data)
+        return str(self._tracks)
 
+    # comparing hashes first means states that are different almost never need the full comparison
     def __eq__(self, other) -> bool:
-        return self._data == other._data
+        if self.hash_value() != other.hash_value():
+            return False
+        return self._tracks == other._tracks
     
     def __hash__(self) -> int:
-        return hash(self._data)
+        return self.hash_value()
+
+    def hash_value(self) -> int:
+        if self._hash is None:
+            self._track_hashes = {track: _hash_track(cars) for track, cars in self._tracks.items()}
+            self._hash = sum(_track_key(track) * track_hash for track, track_hash in self._track_hashes.items()) % HASH_MODULUS
+        return self._hash
 
     # returns whether there aren't cars on a particular track
     def is_track_empty(self, track: int) -> bool:
-        return len(self._data[track]) == 0
+        return len(self._tracks[track]) == 0
     
     # returns the total number of cars on any track
     def count_number_of_cars(self) -> int:
@@ -64,6 +135,14 @@ class State:
     # returns the number of cars on a particular track
     def number_of_cars_on_track(self, track: int) -> int:
         return len(self._data[track])
+
+    # returns the ordered cars on a particular track (don't modify it!)
+    def get_cars_on_track(self, track: int) -> list[str]:
+        return self._tracks.get(track, [])
+
+    # returns every track this state knows about, including empty ones
+    def get_tracks(self) -> list[int]:
+        return sorted(self._tracks)
     
     @staticmethod
     def number_of_cars_on_correct_track(current_state: State, goal_state: State) -> int:
@@ -74,26 +153,72 @@ class State:
                     count += 1
         return count
 
+    # same as number_of_cars_on_correct_track(self, goal_state), but cached and kept up to date by
+    # perform_internal_action, so it's only counted from scratch once per search
+    def correct_cars(self, goal_state: State) -> int:
+        if self._goal is not goal_state:
+            self._goal = goal_state
+            self._correct_cars = State.number_of_cars_on_correct_track(self, goal_state)
+        return self._correct_cars
+
+    # (car, track) -> how many cars with that name are on that track, for looking up where a car is supposed to end up
+    # (counted rather than car -> track since car names can repeat)
+    def goal_counts(self) -> Counter[tuple[str, int]]:
+        if self._goal_counts is None:
+            self._goal_counts = Counter((car, track) for track, cars in self._tracks.items() for car in cars)
+        return self._goal_counts
+
     # performs the provided Action, modifying the internal data structure
     # as opposed to, like, returning a new State or something
     # note this doesn't do any error checking; that's done elsewhere in the program
     def perform_internal_action(self, action: Action):
         from_track = action.connection[0]
         to_track = action.connection[1]
+        from_cars = self._tracks[from_track]
+        to_cars = self._tracks[to_track]
+        track_hashes = self._track_hashes if self._hash is not None else None
+        if track_hashes is not None:
+            old_from_hash = track_hashes.get(from_track, 0)
+            old_to_hash = track_hashes.get(to_track, 0)
 
         if action.type == "l":
-            left_most_from_track_y = self._data[from_track].pop(0)
-            self._data[to_track].append(left_most_from_track_y)
+            car = from_cars.pop(0)
+            to_cars.append(car)
+            if track_hashes is not None: # everything left on from_track shifts down one position
+                new_from_hash = (old_from_hash - _car_key(car)) * HASH_BASE_INVERSE % HASH_MODULUS
+                new_to_hash = (old_to_hash + _car_key(car) * _base_power(len(to_cars) - 1)) % HASH_MODULUS
         else:
-            right_most_from_track_x = self._data[from_track].pop()
-            self._data[to_track].insert(0, right_most_from_track_x)
+            car = from_cars.pop()
+            to_cars.insert(0, car)
+            if track_hashes is not None: # everything already on to_track shifts up one position
+                new_from_hash = (old_from_hash - _car_key(car) * _base_power(len(from_cars))) % HASH_MODULUS
+                new_to_hash = (_car_key(car) + old_to_hash * HASH_BASE) % HASH_MODULUS
+
+        if track_hashes is not None:
+            track_hashes[from_track] = new_from_hash
+            track_hashes[to_track] = new_to_hash
+            self._hash = (self._hash + _track_key(from_track) * (new_from_hash - old_from_hash) + _track_key(to_track) * (new_to_hash - old_to_hash)) % HASH_MODULUS
+        if self._goal is not None:
+            # number_of_cars_on_correct_track counts every goal car whose name is anywhere on its goal track,
+            # so only the last car with its name leaving a track or the first one arriving changes anything
+            goal_counts = self._goal.goal_counts()
+            if (car, from_track) in goal_counts and car not in from_cars:
+                self._correct_cars -= goal_counts[(car, from_track)]
+            if (car, to_track) in goal_counts and to_cars.count(car) == 1:
+                self._correct_cars += goal_counts[(car, to_track)]
+        if car == "*":
+            self._engine_track = to_track
     
     # returns the track that contains the engine
     def get_track_with_engine(self) -> int:
-        for track in self._data:
-            if "*" in self._data[track]:
-                return track
-        raise Exception("State doesn't contain an engine!")
+        if self._engine_track is None:
+            for track in self._tracks:
+                if "*" in self._tracks[track]:
+                    self._engine_track = track
+                    break
+            else:
+                raise Exception("State doesn't contain an engine!")
+        return self._engine_track
 
 class Action:
     def __init__(self, type: Literal["l", "r"], connection: tuple[int, int]):
@@ -152,3 +277,106 @@ def expand(state: State, yard: Yard) -> list[State]:
 # does the same but the list contains tuples of State and the Action it performed from previous state -> this one
 def expand_with_actions(state: State, yard: Yard) -> list[tuple[State, Action]]:
     return [(result(action, state), action) for action in possible_actions(yard, state)]
+
+# up-front analysis, so problems without a plan get rejected before any searching
+
+class UnsolvableError(Exception):
+    pass
+
+# searches that take a stop callback call it every STOP_CHECK_INTERVAL expansions and raise this when it returns True
+STOP_CHECK_INTERVAL = 256
+
+class SearchStopped(Exception):
+    pass
+
+# returns every track reachable from track by switches in either direction (including track itself)
+def connected_tracks(yard: Yard, track: int) -> set[int]:
+    tracks = {track}
+    fringe = deque([track])
+    while len(fringe) != 0:
+        current_track = fringe.popleft()
+        for other_track in yard.get_all_right_connections(current_track) | yard.get_all_left_connections(current_track):
+            if other_track not in tracks:
+                tracks.add(other_track)
+                fringe.append(other_track)
+    return tracks
+
+# if the tracks are a single line 1 -> 2 -> ... -> k with no branches, returns them in order, otherwise None
+# moving a car along a line just moves it from the end of one track to the start of the next,
+# so reading the cars along the line left to right always gives the same order
+def _line_order(yard: Yard, tracks: set[int]) -> list[int] | None:
+    for track in tracks:
+        if len(yard.get_all_right_connections(track)) > 1 or len(yard.get_all_left_connections(track)) > 1:
+            return None
+    starts = [track for track in tracks if not yard.get_all_left_connections(track)]
+    if len(starts) != 1: # a loop
+        return None
+    order = [starts[0]]
+    while yard.get_all_right_connections(order[-1]):
+        order.append(next(iter(yard.get_all_right_connections(order[-1]))))
+    return order
+
+def _cars(state: State, tracks: list[int]) -> list[str]:
+    return [car for track in tracks for car in state.get_cars_on_track(track)]
+
+# problems with at most this many rankable states (see ranking.StateRanker) get searched in full before the real search,
+# which decides exactly whether there's a plan and how long the shortest one is
+EXACT_SOLVABILITY_STATES = 20_000
+
+# checks that rule out a problem without searching: returns the reason there's definitely no plan, or None if there might be one
+def _quick_unsolvable_reason(yard: Yard, initial_state: State, goal_state: State) -> str | None:
+    all_tracks = sorted(set(initial_state.get_tracks()) | set(goal_state.get_tracks()))
+    initial_cars = Counter(_cars(initial_state, all_tracks))
+    if initial_cars != Counter(_cars(goal_state, all_tracks)):
+        return "the initial and goal states don't have the same cars"
+    if initial_cars["*"] != 1:
+        return "there has to be exactly one engine"
+
+    # cars can only move on tracks the engine can get to
+    engine_tracks = connected_tracks(yard, initial_state.get_track_with_engine())
+    for track in all_tracks:
+        if track not in engine_tracks and initial_state.get_cars_on_track(track) != goal_state.get_cars_on_track(track):
+            return f"track {track} isn't connected to the engine's track, but its cars have to change"
+
+    line = _line_order(yard, engine_tracks)
+    if line and _cars(initial_state, line) != _cars(goal_state, line):
+        return f"tracks {line} are a single line, so the cars on them can't change order"
+    return None
+
+# returns (the reason there's definitely no plan or None, the length of the shortest plan if the problem was small enough to search)
+def _analyze(yard: Yard, initial_state: State, goal_state: State, stop: Callable[[], bool] | None = None) -> tuple[str | None, int | None]:
+    reason = _quick_unsolvable_reason(yard, initial_state, goal_state)
+    if reason:
+        return (reason, None)
+    from ranking import StateRanker, shortest_plan_length # ranking imports this module
+    try:
+        small = StateRanker.for_problem(yard, initial_state, goal_state).size <= EXACT_SOLVABILITY_STATES
+    except ValueError: # cars with the same name can't be ranked
+        small = False
+    if not small:
+        return (None, None)
+    length = shortest_plan_length(yard, initial_state, goal_state, stop)
+    if length is None:
+        return ("searching every state the engine can reach never gets to the goal", None)
+    return (None, length)
+
+def find_unsolvable_reason(yard: Yard, initial_state: State, goal_state: State) -> str | None:
+    return _analyze(yard, initial_state, goal_state)[0]
+
+# raises UnsolvableError if there's no plan, otherwise returns the most actions the shortest plan can take
+# (exactly its length on small problems, plan_length_bound on the rest)
+def check_solvable(yard: Yard, initial_state: State, goal_state: State, stop: Callable[[], bool] | None = None) -> int:
+    reason, length = _analyze(yard, initial_state, goal_state, stop)
+    if reason:
+        raise UnsolvableError(f"No plan exists: {reason}")
+    return length if length is not None else plan_length_bound(yard, initial_state)
+
+# the shortest plan never visits a state twice, so it's at most (number of states the engine can reach) - 1 actions long
+# that's every arrangement of the cars on the engine's tracks (in a fixed order if those tracks are a single line)
+def plan_length_bound(yard: Yard, initial_state: State) -> int:
+    engine_tracks = connected_tracks(yard, initial_state.get_track_with_engine())
+    number_of_cars = len(_cars(initial_state, sorted(engine_tracks)))
+    number_of_tracks = len(engine_tracks)
+    orders = 1 if _line_order(yard, engine_tracks) else factorial(number_of_cars)
+    return orders * comb(number_of_cars + number_of_tracks - 1, number_of_tracks - 1) - 1
+
@@ -1,10 +1,24 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
 from collections import defaultdict
+from concurrent.futures.process import BrokenProcessPool
 
-from switch import Yard, State, Action, possible_actions, result, expand, expand_with_actions
+from switch import Yard, State, Action, possible_actions, result, expand, expand_with_actions, find_unsolvable_reason, plan_length_bound
+from switch import check_solvable, UnsolvableError
+from switch import SearchStopped
+from ranking import StateRanker, VisitedSet, external_bfs
+from search import solve
+from plan import inverse, arrangement, find_plan_error, validate_plans, remove_loops, optimize_plan
+from server import SolveServer, _solve_in_worker, _get_state, _states, PARSE_CACHE_SIZE
 from examples.data import \
     yard_1, init_state_1, other_state_1, \
-    yard_2, init_state_2, \
-    yard_3, init_state_3, goal_state_1
+    yard_2, init_state_2, goal_state_2, \
+    yard_3, init_state_3, goal_state_1, goal_state_3, \
+    yard_4, init_state_4, goal_state_4, \
+    yard_5, init_state_5, goal_state_5
 
 def base_tests():
     test_yard_3 = Yard([(1, 2), (1, 3)])
@@ -39,6 +53,29 @@ def base_tests():
     assert state_1.get_track_with_engine() == 1
     assert state_2.get_track_with_engine() == 2
 
+    print("Asserting State hashes are updated correctly by State.perform_internal_action...")
+    state_3 = State([["*", "a"], ["b", "c"], ["d"]])
+    state_3.hash_value()
+    state_3.correct_cars(goal_state_1)
+    for action in [Action("r", (1, 2)), Action("l", (2, 3)), Action("r", (1, 3)), Action("l", (3, 1)), Action("l", (3, 1))]:
+        state_3.perform_internal_action(action)
+        fresh_state_3 = State([state_3._data[track] for track in (1, 2, 3)])
+        assert state_3.hash_value() == fresh_state_3.hash_value()
+        assert state_3.correct_cars(goal_state_1) == State.number_of_cars_on_correct_track(fresh_state_3, goal_state_1)
+        assert state_3.get_track_with_engine() == fresh_state_3.get_track_with_engine()
+    print("Asserting State.correct_cars matches a fresh count when car names repeat...")
+    duplicate_goal = State([["*", "a"], ["a"], []])
+    state_4 = State([["*"], ["a"], ["a"]])
+    state_4.correct_cars(duplicate_goal)
+    for action in [Action("l", (3, 1)), Action("r", (1, 3)), Action("l", (2, 1)), Action("l", (3, 1)), Action("r", (1, 2)), Action("r", (1, 2))]:
+        state_4.perform_internal_action(action)
+        fresh_state_4 = State([state_4._data[track] for track in (1, 2, 3)])
+        assert state_4.correct_cars(duplicate_goal) == State.number_of_cars_on_correct_track(fresh_state_4, duplicate_goal)
+        assert state_4.hash_value() == fresh_state_4.hash_value()
+    print("Asserting State hashes differ when cars are in a different order...")
+    assert State([["*", "a", "b"]]).hash_value() != State([["*", "b", "a"]]).hash_value()
+    assert State([["*", "a"], ["b"]]).hash_value() != State([["*"], ["a", "b"]]).hash_value()
+
     # code already prevents actions without engines or actions with nonexistent switches
     print("Asserting Action.check_action checks for empty tracks...")
     assert Action("r", (1, 2)).check_action(state_1)
@@ -127,5 +164,170 @@ def problem_3_tests():
     for state in init_state_3_expansion_expected:
         assert state in init_state_3_expansion
 
+def ranking_tests():
+    print("Asserting StateRanker.unrank undoes StateRanker.rank for every state...")
+    ranker = StateRanker(["*", "a", "b"], 3)
+    assert ranker.size == 6 * 10 # 3! orders times 10 ways to split 3 cars over 3 tracks
+    states = [ranker.unrank(rank) for rank in range(ranker.size)]
+    assert [ranker.rank(state) for state in states] == list(range(ranker.size))
+    assert len(set(states)) == ranker.size
+    print("Asserting StateRanker.rank rejects states with different cars...")
+    try:
+        ranker.rank(State([["*", "a", "c"], [], []]))
+        assert False
+    except ValueError:
+        pass
+
+    print("Asserting VisitedSet.add only reports new ranks...")
+    visited = VisitedSet(100)
+    assert visited.add(42)
+    assert not visited.add(42)
+    assert 42 in visited and 41 not in visited and 43 not in visited
+
+    print("Asserting external_bfs finds shortest plans on YARD-3 and YARD-5...")
+    plan, _ = external_bfs(yard_3, init_state_3, goal_state_3)
+    assert plan is not None and len(plan) == 2
+    plan, _ = external_bfs(yard_5, init_state_5, goal_state_5)
+    assert plan is not None and len(plan) == 6
+    state = init_state_5
+    for action in plan:
+        state = result(action, state)
+    assert state == goal_state_5
+    print("Asserting external_bfs proves a single track can't reorder cars...")
+    plan, _ = external_bfs(Yard([(1, 2)]), State([["*", "a", "b"], []]), State([["*", "b", "a"], []]))
+    assert plan is None
+
+def solvability_tests():
+    print("Asserting find_unsolvable_reason accepts the example yards...")
+    assert find_unsolvable_reason(yard_1, init_state_1, goal_state_1) is None
+    assert find_unsolvable_reason(yard_5, init_state_5, goal_state_5) is None
+    print("Asserting find_unsolvable_reason rejects different cars...")
+    assert find_unsolvable_reason(yard_3, init_state_3, State([["*", "a", "c"], [], []]))
+    print("Asserting find_unsolvable_reason rejects changes the engine can't reach...")
+    assert find_unsolvable_reason(Yard([(1, 2), (3, 4)]), State([["*", "a"], [], ["b"], []]), State([["*", "a"], [], [], ["b"]]))
+    print("Asserting find_unsolvable_reason rejects reordering on a single line of tracks...")
+    assert find_unsolvable_reason(Yard([(1, 2), (2, 3)]), State([["*", "a"], ["b"], []]), State([["*", "b", "a"], [], []]))
+    assert find_unsolvable_reason(Yard([(1, 2), (2, 3)]), State([["*", "a"], ["b"], []]), State([[], ["*"], ["a", "b"]])) is None
+    print("Asserting plan_length_bound is at least the shortest plan on YARD-5...")
+    assert plan_length_bound(yard_5, init_state_5) >= 6
+    print("Asserting small problems get searched in full up front...")
+    # a branching yard, so the cheap checks can't rule it out, but the engine can never get track 2's car out of the way
+    yard, init_state, goal_state = Yard([(2, 1), (2, 3)]), State([["a"], ["*", "b"], []]), State([["a"], ["b"], ["*"]])
+    assert find_unsolvable_reason(yard, init_state, goal_state)
+    for method in ("blind", "heuristic", "graph", "external"):
+        try:
+            solve(yard, init_state, goal_state, method)
+            assert False
+        except UnsolvableError:
+            pass
+    print("Asserting check_solvable gives the exact shortest plan length on small problems...")
+    assert check_solvable(yard_5, init_state_5, goal_state_5) == 6
+    assert check_solvable(yard_3, init_state_3, goal_state_3) == 2
+
+def server_tests():
+    print("Asserting solve stops when told to...")
+    try:
+        solve(yard_1, init_state_1, goal_state_1, "graph", lambda: True)
+        assert False
+    except SearchStopped:
+        pass
+    print("Asserting solve agrees with the other searches on YARD-3...")
+    plan, _ = solve(yard_3, init_state_3, goal_state_3, "blind")
+    assert len(plan) == 2
+    print("Asserting the worker caches solutions...")
+    problem = ("((1 2) (1 3))", "((*) (a) (b))", "((* a b) empty empty)")
+    assert _solve_in_worker(*problem, "external", 1e18, 0)["cached"] == False
+    assert _solve_in_worker(*problem, "external", 1e18, 0)["cached"] == True
+    print("Asserting the worker's parse caches stay bounded...")
+    for i in range(PARSE_CACHE_SIZE + 10):
+        _get_state(f"((*) (a{i}) empty)")
+    assert len(_states) == PARSE_CACHE_SIZE
+    print("Asserting SolveServer answers, times out, and rejects bad requests...")
+    async def run():
+        server = SolveServer(1)
+        try:
+            return await asyncio.gather(
+                server.handle(json.dumps({"id": 1, "name": "YARD-3"})),
+                server.handle(json.dumps({"id": 2, "name": "YARD-1", "method": "blind", "timeout": 0})),
+                server.handle("not json"),
+                server.handle(json.dumps({"id": 3, "name": "YARD-3", "timeout": "abc"})),
+                server.handle(json.dumps({"id": 4, "name": "YARD-3", "method": "sideways"})),
+                server.handle(json.dumps({"id": 5, "yard": ["x"], "init": "((*))", "goal": "((*))"})),
+                # no ids, so nothing but the server itself can tell these apart
+                server.handle(json.dumps({"name": "YARD-2", "method": "external"})),
+                server.handle(json.dumps({"name": "YARD-4", "method": "external"}))
+            )
+        finally:
+            server.close()
+    solved, timed_out, bad, bad_timeout, bad_method, bad_yard, no_id_2, no_id_4 = asyncio.run(run())
+    assert solved["id"] == 1 and len(solved["plan"]) == 2
+    assert timed_out == {"id": 2, "error": "timeout"}
+    assert "error" in bad
+    assert bad_timeout["id"] == 3 and bad_timeout["error"].startswith("Bad request")
+    assert bad_method["id"] == 4 and bad_method["error"].startswith("Bad request")
+    assert bad_yard["id"] == 5 and bad_yard["error"].startswith("Bad request")
+    assert no_id_2["id"] is None and "plan" in no_id_2
+    assert no_id_4["id"] is None and "plan" in no_id_4
+    print("Asserting SolveServer survives a worker dying without caching it as the answer...")
+    async def crash():
+        server = SolveServer(2)
+        try:
+            slow = asyncio.create_task(server.handle(json.dumps({"id": 6, "name": "YARD-1", "method": "blind", "timeout": 30})))
+            await asyncio.sleep(0.5)
+            try:
+                await asyncio.wrap_future(server.pool.submit(os._exit, 1))
+            except BrokenProcessPool:
+                pass
+            crashed = await slow
+            cached = len(server.solutions)
+            return crashed, cached, await server.handle(json.dumps({"id": 7, "name": "YARD-3"}))
+        finally:
+            server.close()
+    crashed, cached, after = asyncio.run(crash())
+    assert crashed["id"] == 6 and "error" in crashed and cached == 0
+    assert after["id"] == 7 and len(after["plan"]) == 2
+
+# heavy modules that main.py shouldn't import just to solve a file
+STARTUP_FORBIDDEN_MODULES = ["tests", "examples.data", "server", "asyncio", "concurrent.futures"]
+
+def startup_tests():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    print("Asserting main.py doesn't import tests or the example yards on startup...")
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd = directory, capture_output = True, text = True, check = True)
+    # lines look like "import time:   self [us] | cumulative | imported package"
+    imported = {line.split("|")[-1].strip(): int(line.split("|")[1]) for line in output.stderr.splitlines()[1:] if line.startswith("import time:")}
+    for module in STARTUP_FORBIDDEN_MODULES:
+        assert module not in imported, f"importing main imported {module}"
+    print(f"import main took {imported['main'] / 1000:.1f}ms")
+    print("Asserting solving a file still works...")
+    output = subprocess.run([sys.executable, "main.py", "graph", os.path.join("examples", "yard3.txt")], cwd = directory, capture_output = True, text = True, check = True)
+    assert output.stdout.startswith("Found a solution")
+
+def plan_tests():
+    print("Asserting inverse undoes actions...")
+    assert inverse(Action("r", (1, 2))) == Action("l", (2, 1))
+    assert inverse(inverse(Action("l", (3, 1)))) == Action("l", (3, 1))
+    print("Asserting find_plan_error accepts real plans and leaves the state alone...")
+    plan, _ = solve(yard_2, init_state_2, goal_state_2)
+    state = State.from_state(init_state_2)
+    before = arrangement(state)
+    assert find_plan_error(yard_2, state, plan, goal_state_2) is None
+    assert arrangement(state) == before and state.hash_value() == init_state_2.hash_value()
+    print("Asserting find_plan_error catches bad plans...")
+    assert find_plan_error(yard_3, State.from_state(init_state_3), [Action("r", (2, 3))]) # no switch from 2 to 3
+    assert find_plan_error(yard_3, State.from_state(init_state_3), [Action("r", (1, 2)), Action("r", (1, 2))]) # track 1 is empty
+    assert find_plan_error(yard_4, State.from_state(init_state_4), [Action("l", (3, 1))]) is None
+    assert find_plan_error(yard_4, State.from_state(init_state_4), [Action("l", (3, 1))], goal_state_4) # not finished
+    assert validate_plans(yard_2, init_state_2, [plan, plan[:-1], plan], goal_state_2)[::2] == [None, None]
+    print("Asserting remove_loops cuts out moves that get undone...")
+    wasteful = [Action("r", (1, 2)), Action("l", (2, 1))] + plan[:3] + [inverse(plan[2]), plan[2]] + plan[3:]
+    assert remove_loops(init_state_2, wasteful) == plan
+    print("Asserting optimize_plan shortens plans without changing where they end up...")
+    detour = [Action("l", (3, 1)), Action("l", (4, 1)), Action("r", (1, 4)), Action("r", (1, 3))] # move b and c over and back
+    optimized = optimize_plan(yard_4, init_state_4, detour + [Action("l", (2, 1)), Action("l", (3, 1)), Action("l", (3, 1)), Action("l", (4, 1))])
+    assert find_plan_error(yard_4, State.from_state(init_state_4), optimized, goal_state_4) is None
+    assert len(optimized) == 4
+    assert optimize_plan(yard_2, init_state_2, plan) == plan
+
 def debug_tests():
     State.number_of_cars_on_correct_track(init_state_1, goal_state_1)
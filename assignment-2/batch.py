@@ -0,0 +1,365 @@
+# trains agents on lots of maps at once: every map's q table is one row of an (maps, states, actions) array
+# and all of the agents take their steps together, so hundreds of maps share one python loop instead of needing one each
+# each map ends up exactly where a single qlearn.learn(..., seed = seed) run would:
+# - the map, environment and agent are made the same way (qlearn.make_learning_environment)
+# - every random number comes from the same generator in the same order as in the single run
+# - policy_delta and v_delta are tested on the stacked q tables for every map that ended an episode on the same step,
+#   drawing the same tie-breaking numbers get_policy_representation would; other criteria go through each map's own
+#   LearningEnvironment, which sees its row of the q table
+
+from time import perf_counter
+from typing import Callable
+
+import numpy as np
+
+import qlearn
+from qlearn import Schedule, VisitCountSchedule, LearningEnvironment, RandomStream, Exploration, ConvergenceCriteria, spawn_seeds, MAX_STEPS, POSSIBLE_ACTIONS, RANDOM_BLOCK_SIZE
+
+BATCH_TAIL_MAPS = 4 # once this few maps are still learning, they're finished one by one without numpy
+ACTION_CODES = np.frombuffer(b"0123", dtype = np.uint8) # what get_policy_representation writes for each action
+
+# one block of random numbers per map, with an index per map so they can all be handed out at once
+# refills[m]() has to return the numbers map m's generator would have produced next
+class StackedRandom:
+    def __init__(self, refills: list[Callable[[], np.ndarray]]):
+        self.refills = refills
+        self.sources: list[np.ndarray] = [refill() for refill in refills] # the array each row was last copied from
+        self.blocks = np.stack(self.sources)
+        self.index = np.zeros(len(refills), dtype = np.int64)
+
+    # the next count numbers for each map in maps, as an array of (maps) or (maps, count)
+    def draw(self, maps: np.ndarray, count: int = 1) -> np.ndarray:
+        index = self.index[maps]
+        if index.max() + count > self.blocks.shape[1]: # somebody runs out partway, so go one number at a time
+            numbers = np.stack([self._draw_one(maps) for _ in range(count)], axis = 1)
+            return numbers[:, 0] if count == 1 else numbers
+        self.index[maps] = index + count
+        if count == 1:
+            return self.blocks[maps, index]
+        return self.blocks[maps[:, None], index[:, None] + np.arange(count)]
+
+    # counts[i] numbers for map maps[i], all in one flat array one map after another
+    def draw_ragged(self, maps: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        index = self.index[maps]
+        if (index + counts > self.blocks.shape[1]).any():
+            return np.concatenate([self._take(m, count) for m, count in zip(maps.tolist(), counts.tolist())])
+        starts = np.cumsum(counts) - counts # where each map's numbers start in the result
+        positions = np.repeat(index - starts, counts) + np.arange(int(counts.sum()))
+        self.index[maps] = index + counts
+        return self.blocks[np.repeat(maps, counts), positions]
+
+    # count numbers for map m, going on into new blocks as needed (the generator hands out the same numbers either way)
+    def _take(self, m: int, count: int) -> np.ndarray:
+        numbers = []
+        while count > 0:
+            if self.index[m] == self.blocks.shape[1]:
+                self.sources[m] = self.refills[m]()
+                self.blocks[m] = self.sources[m]
+                self.index[m] = 0
+            index = int(self.index[m])
+            taken = min(count, self.blocks.shape[1] - index)
+            numbers.append(self.blocks[m, index:index + taken].copy()) # the row gets overwritten by the next refill
+            self.index[m] = index + taken
+            count -= taken
+        return np.concatenate(numbers) if numbers else np.empty(0)
+
+    def _draw_one(self, maps: np.ndarray) -> np.ndarray:
+        index = self.index[maps]
+        exhausted = index == self.blocks.shape[1]
+        for m in maps[exhausted].tolist():
+            self.sources[m] = self.refills[m]()
+            self.blocks[m] = self.sources[m]
+        index[exhausted] = 0
+        self.index[maps] = index + 1
+        return self.blocks[maps, index]
+
+    # gives map m's position back to its RandomStream so regular python code can draw from it
+    def lend(self, m: int, stream: RandomStream):
+        stream.index = int(self.index[m])
+
+    # and takes it back afterwards, picking up a new block if the stream moved on to one
+    def reclaim(self, m: int, stream: RandomStream):
+        if stream.index == len(stream.values):
+            stream.next_block()
+        if stream.block is not self.sources[m]:
+            self.sources[m] = stream.block
+            self.blocks[m] = stream.block
+        self.index[m] = stream.index
+
+# LearningEnvironment's convergence state for every map, as arrays so the maps that ended an episode together get tested together
+# store(m) writes map m's back to its LearningEnvironment, which is where the tail loop and the other criteria keep it
+class StackedConvergence:
+    def __init__(self, convergence_criteria: ConvergenceCriteria, learning_environments: list[LearningEnvironment], q_tables: np.ndarray, agent_random: StackedRandom):
+        self.criteria, self.param = convergence_criteria
+        self.learning_environments = learning_environments
+        self.q_tables = q_tables
+        self.agent_random = agent_random
+
+        number_of_maps, number_of_states, _ = q_tables.shape
+        self.episodes = np.zeros(number_of_maps, dtype = np.int64)
+        self.has_won = np.zeros(number_of_maps, dtype = bool)
+        self.converged_episodes = np.zeros(number_of_maps, dtype = np.int64)
+        self.policy_deltas = np.full(number_of_maps, -1, dtype = np.int64) # -1 for None
+        self.previous_policies = np.full((number_of_maps, number_of_states), ord("x"), dtype = np.uint8)
+        self.previous_v_values = np.zeros((number_of_maps, number_of_states))
+        state_representations = np.stack([learning_environment.agent.state_representation for learning_environment in learning_environments])
+        # holes and goals always get "h" and "g" whatever their q values are, everywhere else gets 0 here
+        self.fixed_policies = np.where(state_representations == b"H", ord("h"), np.where(state_representations == b"G", ord("g"), 0)).astype(np.uint8)
+
+    # ends an episode for each map in maps, returning which of them converged (those that didn't move on to their next episode)
+    def end_episodes(self, maps: np.ndarray, won: np.ndarray) -> np.ndarray:
+        self.has_won[maps[won]] = True
+        self.policy_deltas[maps] = -1
+        converged = np.zeros(len(maps), dtype = bool)
+        if self.criteria == "policy_delta":
+            check = self.has_won[maps]
+            converged[check] = self._test_policy_delta(maps[check])
+        elif self.criteria == "v_delta":
+            check = self.has_won[maps] & (self.episodes[maps] >= 100) # same as _test_convergence_v_delta
+            converged[check] = self._test_v_delta(maps[check])
+        elif self.criteria != "none":
+            for i, m in enumerate(maps.tolist()):
+                learning_environment = self.learning_environments[m]
+                self.store(m)
+                self.agent_random.lend(m, learning_environment.agent.random)
+                converged[i] = bool(learning_environment.test_convergence())
+                self.agent_random.reclaim(m, learning_environment.agent.random)
+        self.episodes[maps[~converged]] += 1
+        return converged
+
+    # LearningEnvironment._test_convergence_policy_delta with Agent.get_policy_representation, for every map in maps at once
+    def _test_policy_delta(self, maps: np.ndarray) -> np.ndarray:
+        q_tables = self.q_tables[maps]
+        number_of_actions = q_tables.shape[2]
+        is_best = q_tables == q_tables.max(axis = 2, keepdims = True)
+        number_best = is_best.sum(axis = 2)
+        best_actions = is_best.argmax(axis = 2)
+
+        # tied rows come out of is_best[tied] map by map and state by state, the order each map draws their keys in
+        tied = (number_best > 1) & (number_best < number_of_actions)
+        if tied.any():
+            keys = self.agent_random.draw_ragged(maps, tied.sum(axis = 1) * number_of_actions).reshape(-1, number_of_actions)
+            best_actions[tied] = np.where(is_best[tied], keys, -1.0).argmax(axis = 1)
+        policies = np.where(number_best == number_of_actions, ord("?"), ACTION_CODES[best_actions])
+        fixed_policies = self.fixed_policies[maps]
+        policies = np.where(fixed_policies != 0, fixed_policies, policies)
+
+        deltas = (policies != self.previous_policies[maps]).sum(axis = 1)
+        self.previous_policies[maps] = policies
+        self.policy_deltas[maps] = deltas
+        stable = deltas == 0
+        self.converged_episodes[maps] = np.where(stable, self.converged_episodes[maps] + 1, 0)
+        return stable & (self.converged_episodes[maps] >= self.param)
+
+    # LearningEnvironment._test_convergence_v_delta for every map in maps at once
+    def _test_v_delta(self, maps: np.ndarray) -> np.ndarray:
+        v_values = self.q_tables[maps].mean(axis = 2)
+        v_deltas = np.abs(v_values - self.previous_v_values[maps])
+        self.previous_v_values[maps] = v_values
+        return ~(v_deltas > self.param).any(axis = 1)
+
+    def store(self, m: int):
+        learning_environment = self.learning_environments[m]
+        learning_environment.episode = int(self.episodes[m])
+        learning_environment.has_won = bool(self.has_won[m])
+        if self.criteria == "policy_delta":
+            learning_environment.previous_policy = self.previous_policies[m].tobytes().decode("ascii")
+            learning_environment.converged_episodes = int(self.converged_episodes[m])
+            learning_environment.policy_delta = None if self.policy_deltas[m] < 0 else int(self.policy_deltas[m])
+        elif self.criteria == "v_delta":
+            learning_environment.previous_v_values = self.previous_v_values[m].copy()
+
+# same arguments as qlearn.learn, except there's one map per seed
+# returns the number of episodes each map took, which is what qlearn.learn would have returned for that seed
+# only epsilon_greedy and random exploration are supported, with schedules that step per episode
+def learn_batch(
+    seeds: list[int | None],
+    size: int,
+    success_rate: float,
+    alpha: float | Schedule,
+    gamma: float,
+    exploration: Exploration,
+    convergence_criteria: ConvergenceCriteria,
+    reward_schedule: tuple[float, float, float] = (10, -10, 0),
+    max_steps: int = MAX_STEPS
+) -> list[int]:
+    if exploration[0] not in ("epsilon_greedy", "random"):
+        raise ValueError("learn_batch only supports epsilon_greedy and random exploration")
+
+    start_time = perf_counter()
+    learning_environments = []
+    for seed in seeds:
+        _, map_seed, env_seed, agent_seed = spawn_seeds(seed)
+        learning_environments.append(qlearn.make_learning_environment(
+            size, success_rate, alpha, gamma, exploration, convergence_criteria, reward_schedule, map_seed, env_seed, agent_seed
+        ))
+    agents = [learning_environment.agent for learning_environment in learning_environments]
+    for agent in agents:
+        schedules = [schedule for schedule in (agent.alpha_schedule, agent.epsilon_schedule) if schedule]
+        if any(schedule.unit != "episode" or isinstance(schedule, VisitCountSchedule) for schedule in schedules):
+            raise ValueError("learn_batch only supports schedules that step per episode and don't depend on the state")
+
+    number_of_maps = len(seeds)
+    number_of_states = len(agents[0].state_representation)
+    number_of_actions = len(POSSIBLE_ACTIONS)
+    max_episode_steps = learning_environments[0].env.spec.max_episode_steps # pyright: ignore[reportOptionalMemberAccess]
+
+    # every env.unwrapped.P[s][a] as arrays, with the cumulative probabilities FrozenLake samples from
+    # unused outcomes get -inf so they're never picked, the same way np.argmax(cumsum > u) would skip them
+    outcomes = 3 if success_rate != 1 else 1
+    shape = (number_of_maps, number_of_states, number_of_actions, outcomes)
+    # every list gets padded out to the same length with impossible outcomes so it all goes into numpy at once
+    all_transitions = [
+        P[s][a] for P in (learning_environment.env.unwrapped.P for learning_environment in learning_environments) # pyright: ignore[reportAttributeAccessIssue]
+        for s in range(number_of_states) for a in POSSIBLE_ACTIONS
+    ]
+    used = (np.arange(outcomes) < np.array([len(transitions) for transitions in all_transitions])[:, None]).reshape(shape)
+    padding = (0.0, 0, 0.0, False)
+    probabilities, next_states, rewards, terminated = (
+        np.array(column).reshape(shape)
+        for column in zip(*(outcome for transitions in all_transitions for outcome in transitions + [padding] * (outcomes - len(transitions))))
+    )
+    cumulative = np.where(used, probabilities.cumsum(axis = 3), -np.inf)
+    start_states = np.array([int(np.flatnonzero(agent.state_representation == b"S")[0]) for agent in agents])
+
+    q_tables = np.zeros((number_of_maps, number_of_states, number_of_actions))
+    for m, agent in enumerate(agents):
+        agent.q_table = q_tables[m] # a view, so convergence tests see the batched updates
+    alphas = np.array([agent.alpha for agent in agents])
+    epsilons = np.array([agent.epsilon_schedule.value if agent.epsilon_schedule else 0.0 for agent in agents])
+
+    # flat views so each step is a handful of 1d lookups: q row (m, s) is m * states + s,
+    # (m, s, a) is row * actions + a, and (m, s, a, outcome) is that * outcomes + outcome
+    q_rows = q_tables.reshape(-1, number_of_actions)
+    q_flat = q_tables.reshape(-1)
+    cumulative = cumulative.reshape(-1, outcomes)
+    next_states = next_states.reshape(-1)
+    rewards = rewards.reshape(-1)
+    terminated = terminated.reshape(-1)
+
+    agent_random = StackedRandom([agent.random.next_block for agent in agents])
+    env_random = StackedRandom([
+        lambda generator = learning_environment.env.unwrapped.np_random: generator.random(RANDOM_BLOCK_SIZE) # pyright: ignore[reportAttributeAccessIssue]
+        for learning_environment in learning_environments
+    ])
+    convergence = StackedConvergence(convergence_criteria, learning_environments, q_tables, agent_random)
+
+    # everything below is only kept for the maps that are still learning, in the same order as active
+    # every one of them takes a step each time around, so they've all taken step steps so far
+    active = np.arange(number_of_maps)
+    env_random.draw(active) # LearningEnvironment.learn resets once more before its first step, which draws a number
+    states = start_states.copy()
+    lengths = np.zeros(number_of_maps, dtype = np.int64)
+    first_rows = active * number_of_states
+    steps = np.zeros(number_of_maps, dtype = np.int64)
+    step = 0
+
+    # once only a few maps are left a step costs more than it saves, so those get finished one at a time
+    while len(active) > BATCH_TAIL_MAPS and step < max_steps:
+        rows = first_rows + states
+        q_values = q_rows[rows]
+
+        # Agent.act, where random.choice(options) is options[int(u * len(options))]
+        if exploration[0] == "epsilon_greedy":
+            u = agent_random.draw(active, 2)
+            explore = u[:, 0] < epsilons
+            u = u[:, 1] # used by choice whether it's exploring or following pi
+            is_best = q_values == q_values.max(axis = 1, keepdims = True)
+            k = (u * is_best.sum(axis = 1)).astype(np.int64)
+            best_actions = (is_best.cumsum(axis = 1) > k[:, None]).argmax(axis = 1) # the k-th best action
+            actions = np.where(explore, (u * number_of_actions).astype(np.int64), best_actions)
+        else:
+            actions = (agent_random.draw(active) * number_of_actions).astype(np.int64)
+
+        # env.step, which picks an outcome with np.argmax(cumsum > u)
+        state_actions = rows * number_of_actions + actions
+        outcome = (cumulative[state_actions] > env_random.draw(active)[:, None]).argmax(axis = 1)
+        transitions = state_actions * outcomes + outcome
+        states = next_states[transitions]
+        r = rewards[transitions]
+
+        # Agent.compute_q, with the operations in the same order so the floats come out the same
+        max_q_values = q_rows[first_rows + states].max(axis = 1)
+        q_flat[state_actions] = (1 - alphas) * q_flat[state_actions] + alphas * (r + gamma * max_q_values)
+        lengths += 1
+        step += 1
+
+        ended = np.flatnonzero(terminated[transitions] | (lengths >= max_episode_steps))
+        if len(ended) == 0:
+            continue
+        ended_maps = active[ended]
+        for i, m in zip(ended.tolist(), ended_maps.tolist()):
+            agent = agents[m]
+            agent.step_schedules("episode")
+            alphas[i] = agent.alpha
+            epsilons[i] = agent.epsilon_schedule.value if agent.epsilon_schedule else 0.0
+        converged = convergence.end_episodes(ended_maps, r[ended] > 0)
+
+        restarted = ended[~converged]
+        if len(restarted) != 0:
+            env_random.draw(active[restarted])
+            states[restarted] = start_states[active[restarted]]
+            lengths[restarted] = 0
+        if converged.any():
+            steps[ended_maps[converged]] = step
+            for m in ended_maps[converged].tolist():
+                learning_environments[m].converged = True
+            keep = np.ones(len(active), dtype = bool)
+            keep[ended[converged]] = False
+            active, states, lengths, first_rows, alphas, epsilons = active[keep], states[keep], lengths[keep], first_rows[keep], alphas[keep], epsilons[keep]
+    steps[active] = step
+    for m in range(number_of_maps):
+        convergence.store(m)
+
+    # the same loop for one map with plain python, using the agent and its RandomStream directly
+    for i, m in enumerate(active.tolist()):
+        learning_environment = learning_environments[m]
+        agent = agents[m]
+        agent_random.lend(m, agent.random)
+        env_block = env_random.blocks[m].tolist()
+        env_index = int(env_random.index[m])
+        rows = slice(m * number_of_states * number_of_actions, (m + 1) * number_of_states * number_of_actions)
+        transitions = slice(rows.start * outcomes, rows.stop * outcomes)
+        map_cumulative = cumulative[rows].tolist()
+        map_next_states, map_rewards, map_terminated = next_states[transitions].tolist(), rewards[transitions].tolist(), terminated[transitions].tolist()
+        s, length, step = int(states[i]), int(lengths[i]), int(steps[m])
+        while step < max_steps:
+            a = agent.act(s)
+            if env_index == len(env_block):
+                env_block = env_random.refills[m]().tolist()
+                env_index = 0
+            u = env_block[env_index]
+            env_index += 1
+            outcome = next((i for i, c in enumerate(map_cumulative[s * number_of_actions + a]) if c > u), 0)
+            transition = (s * number_of_actions + a) * outcomes + outcome
+            s_prime, r, done = map_next_states[transition], map_rewards[transition], map_terminated[transition]
+            learning_environment.compute_q(s, a, r, s_prime)
+            s = s_prime
+            length += 1
+            step += 1
+
+            if done or length >= max_episode_steps:
+                if _end_episode(learning_environment, r > 0):
+                    learning_environment.converged = True
+                    break
+                learning_environment.episode += 1
+                if env_index == len(env_block):
+                    env_block = env_random.refills[m]().tolist()
+                    env_index = 0
+                env_index += 1 # the reset
+                s, length = int(start_states[m]), 0
+        steps[m] = step
+
+    for m, learning_environment in enumerate(learning_environments):
+        learning_environment.steps = int(steps[m])
+    seconds = perf_counter() - start_time
+    print(f"Trained {number_of_maps} maps in {seconds:.1f}s, {steps.sum() / seconds:.0f} steps/s")
+    return [learning_environment.episode for learning_environment in learning_environments]
+
+# the end of an episode goes through the map's own objects, like it does in LearningEnvironment.learn
+def _end_episode(learning_environment: LearningEnvironment, won: bool) -> bool:
+    learning_environment.agent.step_schedules("episode")
+    if won:
+        learning_environment.has_won = True
+    learning_environment.policy_delta = None
+    return learning_environment.test_convergence()
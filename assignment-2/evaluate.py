@@ -0,0 +1,138 @@
+# measures how good a learned policy actually is by playing lots of episodes with it at once
+# the slippery model is the same one FrozenLake uses: the intended direction with probability success_rate,
+# otherwise one of the two perpendicular directions with probability (1 - success_rate) / 2 each
+
+from math import sqrt
+from statistics import NormalDist
+
+import numpy as np
+
+EVALUATION_EPISODES = 100_000
+MIN_EVALUATION_STEPS = 100 # same as FrozenLake's default max_episode_steps
+
+# row, column change for left, down, right, up (the same order as FrozenLake's actions)
+MOVES = np.array([(0, -1), (1, 0), (0, 1), (-1, 0)])
+
+class Evaluation:
+    def __init__(self, episodes: int, successes: int, holes: int, steps: np.ndarray, won: np.ndarray, confidence: float):
+        self.episodes = episodes
+        self.successes = successes
+        self.holes = holes
+        self.truncated = episodes - successes - holes
+        self.success_rate = successes / episodes
+        self.confidence = confidence
+        self.interval = wilson_interval(successes, episodes, confidence)
+        self.mean_steps = float(steps.mean())
+        self.mean_steps_to_goal = float(steps[won].mean()) if successes else float("nan")
+
+    def __repr__(self) -> str:
+        low, high = self.interval
+        return (
+            f"Success rate {self.success_rate:.4f} ({self.confidence:.0%} CI {low:.4f}-{high:.4f}) over {self.episodes} episodes, "
+            f"{self.holes} holes, {self.truncated} truncated, "
+            f"{self.mean_steps:.1f} mean steps ({self.mean_steps_to_goal:.1f} when reaching the goal)"
+        )
+
+# confidence interval for a success probability, which unlike the normal approximation behaves near 0 and 1
+def wilson_interval(successes: int, trials: int, confidence: float = 0.95) -> tuple[float, float]:
+    if trials == 0:
+        return (0.0, 1.0)
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denominator
+    margin = z * sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return (max(0.0, center - margin), min(1.0, center + margin))
+
+# desc can be a list of row strings or FrozenLake's array of single bytes
+def map_array(desc) -> np.ndarray:
+    if isinstance(desc, np.ndarray):
+        return desc.astype("S1")
+    return np.array([list(row) for row in desc], dtype = "S1")
+
+# next_states[s, d] is where moving in direction d from s ends up (walls just keep you in place)
+def move_table(desc: np.ndarray) -> np.ndarray:
+    rows, columns = desc.shape
+    row, column = np.divmod(np.arange(rows * columns), columns)
+    new_rows = np.clip(row[:, None] + MOVES[:, 0], 0, rows - 1)
+    new_columns = np.clip(column[:, None] + MOVES[:, 1], 0, columns - 1)
+    return new_rows * columns + new_columns
+
+# success rate of a FrozenLake environment, read back out of its transition table
+def environment_success_rate(env) -> float:
+    P = env.unwrapped.P
+    for s in range(len(P)):
+        outcomes = P[s][0]
+        if len(outcomes) == 3:
+            return outcomes[1][0]
+        if not outcomes[0][3]: # a non-terminal state that isn't slippery
+            return 1.0
+    return 1.0
+
+# which actions the policy might take in each state, as an (S, 4) bool array
+# a policy string comes from Agent.get_policy_representation ("?" means any action), a q table gets every tied best action
+def best_action_mask(policy: str | np.ndarray) -> np.ndarray:
+    if isinstance(policy, str):
+        codes = np.frombuffer(policy.encode("ascii"), dtype = np.uint8)
+        mask = codes[:, None] == np.frombuffer(b"0123", dtype = np.uint8)
+        mask[~mask.any(axis = 1)] = True # "?", "h" and "g", though it doesn't matter for the last two
+        return mask
+    q_table = np.asarray(policy, dtype = np.float64)
+    return q_table == q_table.max(axis = 1, keepdims = True)
+
+# plays episodes of the policy at once, each one stepping until it reaches a hole or the goal or runs out of steps
+def evaluate_policy(
+    desc,
+    policy: str | np.ndarray,
+    success_rate: float = 1.0,
+    episodes: int = EVALUATION_EPISODES,
+    max_steps: int | None = None,
+    seed: int | np.random.Generator | None = None,
+    confidence: float = 0.95
+) -> Evaluation:
+    desc = map_array(desc)
+    size = desc.size
+    flat_desc = desc.ravel()
+    next_states = move_table(desc)
+    is_hole = flat_desc == b"H"
+    is_goal = flat_desc == b"G"
+    if max_steps is None:
+        max_steps = max(MIN_EVALUATION_STEPS, 4 * desc.shape[0]) # same truncation qlearn.learn uses
+
+    mask = best_action_mask(policy)
+    if mask.shape != (size, 4):
+        raise ValueError(f"Policy has {mask.shape[0]} states but the map has {size}")
+    number_best = mask.sum(axis = 1)
+    greedy = mask.argmax(axis = 1) # the only choice wherever there's no tie
+    has_ties = bool((number_best > 1).any())
+
+    generator = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+    fail_rate = (1 - success_rate) / 2
+
+    states = np.full(episodes, int(np.flatnonzero(flat_desc == b"S")[0]))
+    steps = np.zeros(episodes, dtype = np.int64)
+    won = np.zeros(episodes, dtype = bool)
+    fell = np.zeros(episodes, dtype = bool)
+    active = np.arange(episodes) # only episodes that haven't ended get stepped
+
+    for _ in range(max_steps):
+        if len(active) == 0:
+            break
+        s = states[active]
+        actions = greedy[s]
+        if has_ties: # pick uniformly between tied actions, like Agent.pi does
+            tied = number_best[s] > 1
+            keys = np.where(mask[s[tied]], generator.random((int(tied.sum()), 4)), -1.0)
+            actions[tied] = keys.argmax(axis = 1)
+        if success_rate < 1:
+            slip = generator.random(len(active))
+            actions = np.where(slip < fail_rate, actions - 1, np.where(slip < fail_rate + success_rate, actions, actions + 1)) % 4
+
+        s = next_states[s, actions]
+        states[active] = s
+        steps[active] += 1
+        won[active] = is_goal[s]
+        fell[active] = is_hole[s]
+        active = active[~(is_goal[s] | is_hole[s])]
+
+    return Evaluation(episodes, int(won.sum()), int(fell.sum()), steps, won, confidence)
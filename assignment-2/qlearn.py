@@ -1,19 +1,25 @@
+import copy
+import json
+import os
 from collections import defaultdict, deque
-from random import choice, random
+from time import perf_counter
+from typing import Literal, TYPE_CHECKING
 
-import gymnasium as gym
-from gymnasium.envs.toy_text.frozen_lake import generate_random_map
+import numpy as np
 
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-from matplotlib.patches import Polygon
+from telemetry import Telemetry
+from evaluate import evaluate_policy, environment_success_rate
 
-import numpy as np
+# gymnasium and matplotlib are slow to import, so they're only imported by the functions that use them
+# that way training without showing the q table never loads matplotlib at all (see "python test.py startup")
+if TYPE_CHECKING:
+    import gymnasium as gym
 
 type Action = int
 type State = int
 type Utility = float
-type Exploration = tuple[str, float]
+type Exploration = tuple[str, float | Schedule]
+type ScheduleUnit = Literal["episode", "step"]
 type ConvergenceCriteria = tuple[str, float]
 
 DRAW_STATE_INDEX = True
@@ -23,23 +29,213 @@ POSSIBLE_ACTIONS: list[Action] = [0, 1, 2, 3]
 SIZE = -1
 IS_SLIPPERY = False
 RENDER_TO_SCREEN = False
+LARGE_MAP_SIZE = 32 # maps bigger than this get drawn as a heatmap instead of per-action triangles
+MAX_STEPS = 1_000_000 # take no more than this many steps in case it doesn't converge in time
+CHECKPOINT_EVERY = 1_000 # episodes between checkpoints when a checkpoint path is given
+RANDOM_BLOCK_SIZE = 4_096 # how many random numbers a RandomStream draws at once
+SUCCESS_RATE_CHECK_EVERY = 100 # episodes between evaluations for the success_rate convergence criteria
+SUCCESS_RATE_EPISODES = 10_000 # rollouts per evaluation
+SUCCESS_RATE_STABLE_CHECKS = 3 # evaluations in a row that have to agree before it counts as converged
+
+# per-agent source of random numbers, backed by a numpy Generator
+# numbers are drawn a block at a time, since one generator call per number is slow
+# the sequence of numbers doesn't depend on the block size, so a seed always gives the same run
+class RandomStream:
+    def __init__(self, seed: int | None = None, block_size: int = RANDOM_BLOCK_SIZE):
+        self.generator = np.random.default_rng(seed)
+        self.block_size = block_size
+        self.block = np.empty(0)
+        self.values: list[float] = [] # same as block, but plain python floats are faster to hand out one at a time
+        self.index = 0
+
+    def _refill(self):
+        self.block = self.generator.random(self.block_size)
+        self.values = self.block.tolist()
+        self.index = 0
+
+    # uniform in [0, 1), like random.random
+    def random(self) -> float:
+        if self.index == len(self.values):
+            self._refill()
+        value = self.values[self.index]
+        self.index += 1
+        return value
+
+    def choice(self, options: list):
+        return options[int(self.random() * len(options))]
+
+    # drops whatever's left of the current block and returns the next one, for batch.py to hand out itself
+    def next_block(self) -> np.ndarray:
+        self._refill()
+        return self.block
+
+    # the next n numbers as an array
+    def take(self, n: int) -> np.ndarray:
+        available = len(self.values) - self.index
+        if n <= available:
+            numbers = self.block[self.index:self.index + n]
+            self.index += n
+            return numbers
+        # use up what's left of this block, then get the rest straight from the generator
+        numbers = np.concatenate([self.block[self.index:], self.generator.random(n - available)])
+        self.block = np.empty(0)
+        self.values = []
+        self.index = 0
+        return numbers
+
+    # flat representation for checkpoints
+    def get_state(self) -> dict[str, np.ndarray]:
+        return {
+            "generator": np.array(json.dumps(self.generator.bit_generator.state)),
+            "block": self.block.copy(),
+            "index": np.int64(self.index)
+        }
+
+    def set_state(self, state: dict[str, np.ndarray]):
+        self.generator.bit_generator.state = json.loads(str(state["generator"]))
+        self.block = np.array(state["block"], dtype = np.float64)
+        self.values = self.block.tolist()
+        self.index = int(state["index"])
+
+# turns one top level seed into separate seeds for the map, the environment and the agent
+# seed = None picks a random one; the returned entropy is what to pass back in to replay the run
+def spawn_seeds(seed: int | None = None) -> tuple[int, int, int, int]:
+    seed_sequence = np.random.SeedSequence(seed)
+    map_seed, env_seed, agent_seed = [int(child.generate_state(1)[0]) for child in seed_sequence.spawn(3)]
+    return seed_sequence.entropy, map_seed, env_seed, agent_seed # pyright: ignore[reportReturnType]
+
+# a schedule is a value (alpha, epsilon, ...) that changes as learning goes on
+# unit decides whether step() gets called after every episode or after every single step
+class Schedule:
+    def __init__(self, initial: float, unit: ScheduleUnit = "episode"):
+        self.initial = initial
+        self.value = initial
+        self.unit = unit
+        self.t = 0
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(value={self.value}, t={self.t})"
+
+    def step(self):
+        self.t += 1
+        self.value = self.compute(self.t)
+
+    def compute(self, t: int) -> float:
+        return self.initial
+
+    # value to use for this particular visit of s (or (s, a)); most schedules don't care which state it is
+    def for_visit(self, s: State, a: Action | None = None) -> float:
+        return self.value
+
+    # flat array representation for checkpoints
+    def get_state(self) -> np.ndarray:
+        return np.array([self.t, self.value], dtype = np.float64)
+
+    def set_state(self, state: np.ndarray):
+        self.t = int(state[0])
+        self.value = float(state[1])
+
+class ConstantSchedule(Schedule):
+    pass
+
+# value *= decay every step, never going below minimum
+class ExponentialSchedule(Schedule):
+    def __init__(self, initial: float, decay: float, minimum: float = 0.0, unit: ScheduleUnit = "episode"):
+        super().__init__(initial, unit)
+        self.decay = decay
+        self.minimum = minimum
+
+    def step(self): # done by repeated multiplication (not initial * decay ** t) so it matches the old annealing exactly
+        self.t += 1
+        self.value = max(self.minimum, self.value * self.decay)
+
+# goes in a straight line from initial to final over the given number of steps, then stays at final
+class LinearSchedule(Schedule):
+    def __init__(self, initial: float, final: float, steps: int, unit: ScheduleUnit = "episode"):
+        if steps <= 0:
+            raise ValueError("LinearSchedule needs at least one step to get from initial to final")
+        super().__init__(initial, unit)
+        self.final = final
+        self.steps = steps
+
+    def compute(self, t: int) -> float:
+        return self.initial + (self.final - self.initial) * min(t, self.steps) / self.steps
+
+# initial / (1 + rate * t)
+class InverseTimeSchedule(Schedule):
+    def __init__(self, initial: float, rate: float, unit: ScheduleUnit = "episode"):
+        super().__init__(initial, unit)
+        self.rate = rate
+
+    def compute(self, t: int) -> float:
+        return self.initial / (1 + self.rate * t)
+
+# GLIE (greedy in the limit with infinite exploration), meant for epsilon: c / (c + k) after k episodes
+class GLIESchedule(Schedule):
+    def __init__(self, c: float = 1.0, unit: ScheduleUnit = "episode"):
+        super().__init__(1.0, unit)
+        self.c = c
+
+    def compute(self, t: int) -> float:
+        return self.c / (self.c + t)
+
+# scale / N(s, a), where N counts how many times for_visit has been called with that (s, a)
+# when used for epsilon there isn't an action yet, so it counts visits to s instead
+class VisitCountSchedule(Schedule):
+    def __init__(self, scale: float = 1.0, minimum: float = 0.0):
+        super().__init__(scale, "episode")
+        self.scale = scale
+        self.minimum = minimum
+        self.counts = defaultdict(int)
+
+    def compute(self, t: int) -> float: # stepping doesn't do anything, the value only depends on the counts
+        return self.value
+
+    def for_visit(self, s: State, a: Action | None = None) -> float:
+        key = (s, a) if a is not None else (s, -1)
+        self.counts[key] += 1
+        self.value = max(self.minimum, self.scale / self.counts[key])
+        return self.value
+
+    def get_state(self) -> np.ndarray: # [t, value, s_0, a_0, n_0, s_1, a_1, n_1, ...]
+        counts = [x for (s, a), n in self.counts.items() for x in (s, a, n)]
+        return np.array([self.t, self.value, *counts], dtype = np.float64)
+
+    def set_state(self, state: np.ndarray):
+        super().set_state(state)
+        self.counts = defaultdict(int)
+        for i in range(2, len(state), 3):
+            self.counts[(int(state[i]), int(state[i + 1]))] = int(state[i + 2])
+
+# the original hardcoded behavior: alpha *= 0.9999 after each episode, but only on slippery maps
+def legacy_alpha_schedule(alpha: float) -> Schedule:
+    return ExponentialSchedule(alpha, 0.9999) if IS_SLIPPERY else ConstantSchedule(alpha)
 
 class Agent:
-    def __init__(self, environment: gym.Env, exploration: Exploration, alpha: float = 0.1, gamma: float = 0.9):
-        self.alpha = alpha
+    # alpha can be a plain number, in which case it uses legacy_alpha_schedule (so set IS_SLIPPERY first)
+    # all of the agent's random choices come from its own RandomStream seeded with seed
+    def __init__(self, environment: "gym.Env", exploration: Exploration, alpha: float | Schedule = 0.1, gamma: float = 0.9, seed: int | None = None):
+        self.random = RandomStream(seed)
+        self.alpha_schedule = alpha if isinstance(alpha, Schedule) else legacy_alpha_schedule(alpha)
+        self.alpha = self.alpha_schedule.value
+        self.epsilon_schedule = None
         self.gamma = gamma
 
         self.environment = environment
-        self.state_representation = [cell.decode("utf-8") for row in environment.unwrapped.desc for cell in row] if environment else [] # pyright: ignore[reportAttributeAccessIssue]
+        # flat array of map cells as single bytes (b"S", b"F", b"H", b"G"), one byte per state
+        self.state_representation = environment.unwrapped.desc.ravel() if environment else np.array([], dtype = "S1") # pyright: ignore[reportAttributeAccessIssue]
+        self.size = len(environment.unwrapped.desc) if environment else 0 # pyright: ignore[reportAttributeAccessIssue]
+        self.terminal_states = (self.state_representation == b"H") | (self.state_representation == b"G")
 
-        self.q_table = defaultdict(float) # default value for Q(s, a) is 0
+        self.q_table = np.zeros((len(self.state_representation), len(POSSIBLE_ACTIONS))) # q_table[s, a], default value for Q(s, a) is 0
 
         # set the exploration function based on exploration
         if exploration[0] == "random":
             self.act = self._act_random
         elif exploration[0] == "epsilon_greedy":
             self.act = self._act_epsilon_greedy
-            self.epsilon_greedy_param = exploration[1]
+            self.epsilon_schedule = exploration[1] if isinstance(exploration[1], Schedule) else ConstantSchedule(exploration[1])
+            self.epsilon_greedy_param = self.epsilon_schedule.value
         elif exploration[0] == "state_counting":
             self.act = self._act_state_counting
             self.compute_q = self._compute_q_state_counting
@@ -47,18 +243,23 @@ class Agent:
             self.state_counting_param = exploration[1]
         else:
             raise ValueError("Invalid ExplorationType")
+
+        schedules = [schedule for schedule in (self.alpha_schedule, self.epsilon_schedule) if schedule]
+        self._episode_schedules = [schedule for schedule in schedules if schedule.unit == "episode"]
+        self._step_schedules = [schedule for schedule in schedules if schedule.unit == "step"]
     
     def act(self, s: State) -> Action:
         raise NotImplementedError("Agent.act was not set, possibly invalid ExplorationType")
 
     # randomly pick an action every time
     def _act_random(self, s: State) -> Action:
-        return choice(POSSIBLE_ACTIONS)
+        return self.random.choice(POSSIBLE_ACTIONS)
     
     # randomly pick with p = epsilon_greedy_param, otherwise use policy
     def _act_epsilon_greedy(self, s: State) -> Action:
-        if random() < self.epsilon_greedy_param:
-            return choice(POSSIBLE_ACTIONS)
+        self.epsilon_greedy_param = self.epsilon_schedule.for_visit(s) # pyright: ignore[reportOptionalMemberAccess]
+        if self.random.random() < self.epsilon_greedy_param:
+            return self.random.choice(POSSIBLE_ACTIONS)
         else:
             return self.pi(s)
     
@@ -69,9 +270,10 @@ class Agent:
         return max([self._state_counting_f(s, a) for a in POSSIBLE_ACTIONS])
 
     def _compute_q_state_counting(self, s: State, a: Action, r: Utility, s_prime: State) -> float:
-        old_q_value = self.q_table[(s, a)]
-        new_q_value = (1 - self.alpha) * self.q(s, a) + self.alpha * (r + self.gamma * self._max_state_counting_f(s_prime))
-        self.q_table[(s, a)] = new_q_value
+        old_q_value = self.q(s, a)
+        self.alpha = self.alpha_schedule.for_visit(s, a)
+        new_q_value = (1 - self.alpha) * old_q_value + self.alpha * (r + self.gamma * self._max_state_counting_f(s_prime))
+        self.q_table[s, a] = new_q_value
 
         return abs(new_q_value - old_q_value)
 
@@ -79,73 +281,124 @@ class Agent:
     def _act_state_counting(self, s: State) -> Action:
         best_utility = self._max_state_counting_f(s)
         best_actions = [a for a in POSSIBLE_ACTIONS if self._state_counting_f(s, a) == best_utility]
-        a = choice(best_actions)
+        a = self.random.choice(best_actions)
 
         self.state_counts[(s, a)] += 1
         return a
 
     # find max over a of q(s, a)
+    # single rows go through tolist() since plain python floats are a lot faster than numpy scalars for 4 values
     def _max_q_value(self, s: State) -> Utility:
-        return max([self.q(s, a) for a in POSSIBLE_ACTIONS])
+        return max(self.q_table[s].tolist())
     
     def _average_q_value(self, s: State) -> Utility:
-        return sum([self.q(s, a) for a in POSSIBLE_ACTIONS]) / len(POSSIBLE_ACTIONS)
+        return sum(self.q_table[s].tolist()) / len(POSSIBLE_ACTIONS)
 
     # perform a step of q learning, returning difference between old and updated q value
     def compute_q(self, s: State, a: Action, r: Utility, s_prime: State) -> float:
-        old_q_value = self.q_table[(s, a)]
-        new_q_value = (1 - self.alpha) * self.q(s, a) + self.alpha * (r + self.gamma * self._max_q_value(s_prime))
-        self.q_table[(s, a)] = new_q_value
+        old_q_value = self.q(s, a)
+        self.alpha = self.alpha_schedule.for_visit(s, a)
+        new_q_value = (1 - self.alpha) * old_q_value + self.alpha * (r + self.gamma * self._max_q_value(s_prime))
+        self.q_table[s, a] = new_q_value
         
         return abs(new_q_value - old_q_value)
     
     def q(self, s: State, a: Action) -> Utility:
-        return self.q_table[(s, a)]
+        return self.q_table.item(s, a)
     
     # find arg max over a of q(s, a)
     def pi(self, s: State) -> Action:
-        return choice(self._best_actions(s))
+        return self.random.choice(self._best_actions(s))
     
     def _best_actions(self, s: State) -> list[Action]:
-        best_q_value = self._max_q_value(s)
-        best_actions = [action for action in POSSIBLE_ACTIONS if self.q(s, action) == best_q_value]
+        q_values = self.q_table[s].tolist()
+        best_q_value = max(q_values)
+        best_actions = [action for action in POSSIBLE_ACTIONS if q_values[action] == best_q_value]
 
         return best_actions
     
-    # returns the policy as a string
+    # advances every schedule that's stepped per unit ("episode" or "step")
+    def step_schedules(self, unit: ScheduleUnit):
+        for schedule in self._episode_schedules if unit == "episode" else self._step_schedules:
+            schedule.step()
+        self.alpha = self.alpha_schedule.value
+
+    # returns a copy of the q table so it can be written to disk
+    def q_table_array(self) -> np.ndarray:
+        return self.q_table.copy()
+
+    def load_q_table_array(self, q_values: np.ndarray):
+        self.q_table = np.array(q_values, dtype = np.float64)
+
+    # state counts are stored sparsely as rows of (s, a, count), so this only grows with the visited states
+    # the keys matter since the state counting convergence check averages over them
+    def state_counts_array(self) -> np.ndarray:
+        counts = getattr(self, "state_counts", {})
+        return np.array([(s, a, count) for (s, a), count in counts.items()], dtype = np.int64).reshape(-1, 3)
+
+    def load_state_counts_array(self, counts: np.ndarray):
+        if not hasattr(self, "state_counts"):
+            return
+        self.state_counts = defaultdict(lambda: 1)
+        for s, a, count in counts.tolist():
+            self.state_counts[(s, a)] = count
+
+    # seeds the q table with one learned on a related map (i.e. from a checkpoint)
+    # states are matched up by (row, column) so the other map can be a different size
+    def warm_start(self, path: str):
+        with np.load(path) as checkpoint:
+            other_q_values = checkpoint["q_table"]
+            other_size = len(checkpoint["desc"])
+
+        n = min(self.size, other_size)
+        q_grid = self.q_table.reshape(self.size, self.size, len(POSSIBLE_ACTIONS)) # views, so writing to q_grid writes to q_table
+        q_grid[:n, :n] = other_q_values.reshape(other_size, other_size, len(POSSIBLE_ACTIONS))[:n, :n]
+        self.q_table[self.terminal_states] = 0 # terminal states have to stay at 0
+
+    # returns the policy as a string, one character per state
+    # this is done for the whole table at once since it gets called every episode
     def get_policy_representation(self) -> str:
-        policy = []
-        for i, s in enumerate(self.state_representation):
-            if s == "H": # we don't care what action is taken on hole and goal states
-                policy.append("h")
-            if s == "G":
-                policy.append("g")
-            else:
-                best_actions = self._best_actions(i)
-                if len(best_actions) == 4:
-                    policy.append("?")
-                else:
-                    policy.append(str(self.pi(i)))
-        return "".join(policy) # concat into a single string
+        is_best = self.q_table == self.q_table.max(axis = 1, keepdims = True)
+        number_best = is_best.sum(axis = 1)
+        best_actions = is_best.argmax(axis = 1)
+
+        # break ties randomly like pi does, by giving every best action a random key and taking the biggest
+        # only rows with 2 or 3 best actions need random numbers ("?" rows don't matter)
+        tied = np.flatnonzero((number_best > 1) & (number_best < len(POSSIBLE_ACTIONS)))
+        if len(tied) > 0:
+            keys = self.random.take(len(tied) * len(POSSIBLE_ACTIONS)).reshape(len(tied), len(POSSIBLE_ACTIONS))
+            best_actions[tied] = np.where(is_best[tied], keys, -1.0).argmax(axis = 1)
+        policy = np.frombuffer(b"0123", dtype = np.uint8)[best_actions]
+
+        policy[number_best == len(POSSIBLE_ACTIONS)] = ord("?")
+        policy[self.state_representation == b"H"] = ord("h") # we don't care what action is taken on hole and goal states
+        policy[self.state_representation == b"G"] = ord("g")
+        return policy.tobytes().decode("ascii")
 
     def show_q_table(self):
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as colors
+        from matplotlib.patches import Polygon
+
         cmap = plt.colormaps["winter"] # thematic
         _, ax = plt.subplots(figsize = (6, 6))
 
-        # this line of code is awesome
-        q_values = [self.q(row * SIZE + column, action) for row in range(SIZE) for column in range(SIZE) for action in POSSIBLE_ACTIONS]
-        q_min = min(q_values)
-        q_max = max(q_values)
+        q_min = self.q_table.min()
+        q_max = self.q_table.max()
+
+        if self.size > LARGE_MAP_SIZE:
+            self._show_large_q_table(ax, cmap, q_min, q_max)
+            return
 
-        for row in range(SIZE):
-            for column in range(SIZE):
-                s = row * SIZE + column
-                x0, y0 = column, (SIZE - 1) - row
+        for row in range(self.size):
+            for column in range(self.size):
+                s = row * self.size + column
+                x0, y0 = column, (self.size - 1) - row
                 cx, cy = x0 + 0.5, y0 + 0.5 # center of cell
 
-                if self.state_representation[s] == 'H': # if hole, draw red square
+                if self.state_representation[s] == b"H": # if hole, draw red square
                     ax.add_patch(Polygon([(x0, y0), (x0, y0 + 1), (x0 + 1, y0 + 1), (x0 + 1, y0)], facecolor = "red"))
-                elif self.state_representation[s] == 'G': # if goal, draw green square
+                elif self.state_representation[s] == b"G": # if goal, draw green square
                     ax.add_patch(Polygon([(x0, y0), (x0, y0 + 1), (x0 + 1, y0 + 1), (x0 + 1, y0)], facecolor = "green"))
                 else: # otherwise, draw q values
                     triangles = {
@@ -170,8 +423,8 @@ class Agent:
                 if DRAW_STATE_INDEX:
                     ax.text(cx, cy, str(s)) # draw state index
         
-        ax.set_xlim(0, SIZE)
-        ax.set_ylim(0, SIZE)
+        ax.set_xlim(0, self.size)
+        ax.set_ylim(0, self.size)
         ax.set_aspect("equal")
         ax.axis("off")
 
@@ -184,6 +437,26 @@ class Agent:
         plt.tight_layout()
         plt.show()
 
+    # thousands of little triangles is way too much for big maps, so just draw max over a of q(s, a) per cell
+    def _show_large_q_table(self, ax, cmap, q_min, q_max):
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as colors
+
+        v_values = self.q_table.max(axis = 1).reshape(self.size, self.size)
+        image = cmap(colors.Normalize(vmin = q_min, vmax = q_max)(v_values))
+        image[(self.state_representation == b"H").reshape(self.size, self.size)] = colors.to_rgba("red")
+        image[(self.state_representation == b"G").reshape(self.size, self.size)] = colors.to_rgba("green")
+
+        ax.imshow(image, interpolation = "nearest")
+        ax.axis("off")
+
+        sm = plt.cm.ScalarMappable(cmap = cmap, norm = colors.Normalize(vmin = q_min, vmax = q_max))
+        sm.set_array([])
+        plt.colorbar(sm, ax = ax, fraction = 0.046, pad = 0.04, label = "max Q-Value")
+
+        plt.tight_layout()
+        plt.show()
+
 class LearningEnvironment:
     episode_r = 0.0
     rewards_queue_length = 50
@@ -199,12 +472,24 @@ class LearningEnvironment:
             self.policy_delta_param = convergence_criteria[1]
             self.test_convergence = self._test_convergence_policy_delta
         elif convergence_criteria[0] == "v_delta":
-            self.previous_v_values = [0.0] * len(self.agent.state_representation)
+            self.previous_v_values = np.zeros(len(self.agent.state_representation))
             self.v_delta_param = convergence_criteria[1]
             self.test_convergence = self._test_convergence_v_delta
+        elif convergence_criteria[0] == "success_rate":
+            self.previous_success_rate = -1.0
+            self.success_rate_param = convergence_criteria[1]
+            self.environment_success_rate = environment_success_rate(self.env)
+            self.test_convergence = self._test_convergence_success_rate
         else:
             raise ValueError("Invalid ConvergenceCriteria")
 
+        self.has_won = False
+        self.episode = 0
+        self.steps = 0
+        self.converged_episodes = 0
+        self.converged = False # whether the last learn() stopped because test_convergence said so, rather than running out of steps
+        self.policy_delta = None # set by the policy_delta criteria, only used for telemetry
+
     def compute_q(self, s: State, a: Action, r: Utility, s_prime: State) -> float:
         self.episode_r = self.episode_r + 0.1 * r
         return self.agent.compute_q(s, a, r, s_prime)
@@ -224,17 +509,16 @@ class LearningEnvironment:
 
         policy = self.agent.get_policy_representation()
 
-        delta = 0
-        delta_states = []
-        for s in range(len(self.agent.state_representation)):
-            if policy[s] != self.previous_policy[s]:
-                delta_states.append(f"{s}: ({policy[s], self.previous_policy[s]})")
-                delta += 1
-        self.previous_policy = policy
+        # compare the two policies as byte arrays instead of character by character
+        changed = np.frombuffer(policy.encode("ascii"), dtype = np.uint8) != np.frombuffer(self.previous_policy.encode("ascii"), dtype = np.uint8)
+        delta = int(np.count_nonzero(changed))
+        self.policy_delta = delta
         
         if self.episode % 1_000 == 0:
+            delta_states = [f"{s}: ({policy[s], self.previous_policy[s]})" for s in np.flatnonzero(changed).tolist()]
             print(f"policy_delta: {delta}")
             print(f"delta_states: {delta_states}")
+        self.previous_policy = policy
 
         if delta == 0: # policy converged!
             self.converged_episodes += 1
@@ -249,118 +533,331 @@ class LearningEnvironment:
         if self.episode < 100 or not self.has_won:
             return False
 
-        v_values = [self.agent._average_q_value(s) for s in range(len(self.agent.state_representation))]
-        v_deltas = [abs(x - y) for x, y in zip(v_values, self.previous_v_values)]
+        v_values = self.agent.q_table.mean(axis = 1)
+        v_deltas = np.abs(v_values - self.previous_v_values)
         self.previous_v_values = v_values
 
         if self.episode % 1_000 == 0:
-            print(f"v_delta: {sum(v_deltas) / len(v_deltas)}")
+            print(f"v_delta: {v_deltas.mean()}")
 
         # check if every delta is below some epsilon
-        for delta in v_deltas:
-            if delta > self.v_delta_param: # greater than some epsilon
-                return False
-        return True
-
-    def learn(self, show_q_table = True) -> int:
-        self.has_won = False
-        self.episode = 0
-        steps = 0
+        return not (v_deltas > self.v_delta_param).any()
 
-        s, _ = self.env.reset()
-        for steps in range(1_000_000): # take no more than 1,000,000 steps in case it doesn't converge in time
-            a = self.agent.act(s)
-            prev_s = s
+    # rolls out the greedy policy every so often and stops once its success rate stops moving
+    def _test_convergence_success_rate(self):
+        if not self.has_won or self.episode % SUCCESS_RATE_CHECK_EVERY != 0:
+            return False
 
-            s, r, terminated, truncated, _ = self.env.step(a)
-            self.compute_q(prev_s, a, float(r), s)
-            steps += 1
+        # seeded from the agent's stream so runs (and resumed runs) stay reproducible
+        seed = int(self.agent.random.random() * 2 ** 63)
+        evaluation = evaluate_policy(self.env.unwrapped.desc, self.agent.q_table, self.environment_success_rate, SUCCESS_RATE_EPISODES, seed = seed) # pyright: ignore[reportAttributeAccessIssue]
+        delta = abs(evaluation.success_rate - self.previous_success_rate)
+        self.previous_success_rate = evaluation.success_rate
 
-            if terminated or truncated:
-                if IS_SLIPPERY:
-                    self.agent.alpha *= 0.9999 # anneal alpha
+        if self.episode % 1_000 == 0:
+            print(f"success_rate: {evaluation}")
 
-                if float(r) > 0:
-                    self.has_won = True
-                if self.test_convergence():
-                    break
+        # a policy that never reaches the goal hasn't learned anything yet, however steady that is,
+        # and a change smaller than the confidence interval is just noise from the rollouts
+        low, high = evaluation.interval
+        if low > 0 and delta <= max(self.success_rate_param, high - low):
+            self.converged_episodes += 1
+            return self.converged_episodes >= SUCCESS_RATE_STABLE_CHECKS
+        self.converged_episodes = 0
+        return False
 
-                s, _ = self.env.reset()
-                self.episode += 1
+    # writes everything needed to pick learning back up exactly where it left off
+    # this only gets called between episodes, right before the environment is reset
+    def save_checkpoint(self, path: str):
+        agent = self.agent
+        arrays = {
+            "desc": self.env.unwrapped.desc, # pyright: ignore[reportAttributeAccessIssue]
+            "q_table": agent.q_table_array(),
+            "state_counts": agent.state_counts_array(),
+            "alpha": np.float64(agent.alpha),
+            "alpha_schedule": agent.alpha_schedule.get_state(),
+            "episode": np.int64(self.episode),
+            "steps": np.int64(self.steps),
+            "has_won": np.bool_(self.has_won),
+            "episode_r": np.float64(self.episode_r),
+            "converged_episodes": np.int64(self.converged_episodes),
+            # random states so the resumed run makes the same choices the original one would have
+            "env_random": np.array(json.dumps(self.env.unwrapped.np_random.bit_generator.state)) # pyright: ignore[reportAttributeAccessIssue]
+        }
+        for key, value in agent.random.get_state().items():
+            arrays[f"agent_random_{key}"] = value
+        if agent.epsilon_schedule:
+            arrays["epsilon_schedule"] = agent.epsilon_schedule.get_state()
+        if hasattr(self, "previous_policy"):
+            arrays["previous_policy"] = np.array(self.previous_policy)
+        if hasattr(self, "previous_v_values"):
+            arrays["previous_v_values"] = np.array(self.previous_v_values)
+        if hasattr(self, "previous_success_rate"):
+            arrays["previous_success_rate"] = np.float64(self.previous_success_rate)
+
+        # write to a temporary file first so getting killed mid-write doesn't eat the last good checkpoint
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temporary_path, path)
+
+    def load_checkpoint(self, path: str):
+        agent = self.agent
+        with np.load(path) as checkpoint:
+            if not np.array_equal(checkpoint["desc"], self.env.unwrapped.desc): # pyright: ignore[reportAttributeAccessIssue]
+                raise ValueError("Checkpoint was taken on a different map")
+
+            agent.load_q_table_array(checkpoint["q_table"])
+            agent.load_state_counts_array(checkpoint["state_counts"])
+            agent.alpha_schedule.set_state(checkpoint["alpha_schedule"])
+            agent.alpha = float(checkpoint["alpha"])
+            if agent.epsilon_schedule and "epsilon_schedule" in checkpoint:
+                agent.epsilon_schedule.set_state(checkpoint["epsilon_schedule"])
+            self.episode = int(checkpoint["episode"])
+            self.steps = int(checkpoint["steps"])
+            self.has_won = bool(checkpoint["has_won"])
+            self.episode_r = float(checkpoint["episode_r"])
+            self.converged_episodes = int(checkpoint["converged_episodes"])
+            if "previous_policy" in checkpoint:
+                self.previous_policy = str(checkpoint["previous_policy"])
+            if "previous_v_values" in checkpoint:
+                self.previous_v_values = np.array(checkpoint["previous_v_values"], dtype = np.float64)
+            if "previous_success_rate" in checkpoint:
+                self.previous_success_rate = float(checkpoint["previous_success_rate"])
+
+            agent.random.set_state({key: checkpoint[f"agent_random_{key}"] for key in ("generator", "block", "index")})
+            self.env.unwrapped.np_random.bit_generator.state = json.loads(str(checkpoint["env_random"])) # pyright: ignore[reportAttributeAccessIssue]
+
+    # how much memory the learning state takes up and how fast it went
+    def memory_report(self, seconds: float) -> dict[str, float]:
+        agent = self.agent
+        steps_this_run = self.steps - self.first_step
+        return {
+            "states": len(agent.state_representation),
+            "map_bytes": agent.state_representation.nbytes,
+            "q_table_bytes": agent.q_table.nbytes,
+            "state_count_entries": len(getattr(agent, "state_counts", {})),
+            "seconds": seconds,
+            "steps_per_second": steps_this_run / seconds if seconds > 0 else 0.0
+        }
+
+    # builds the per-episode record handed to every Telemetry (see telemetry.TELEMETRY_FIELDS)
+    def _episode_record(self, episode_return: float, length: int, won: bool, dq_sum: float, seconds: float) -> dict:
+        return {
+            "episode": self.episode,
+            "return": episode_return,
+            "length": length,
+            "won": won,
+            "mean_abs_dq": dq_sum / length if length else 0.0,
+            "policy_delta": self.policy_delta,
+            "epsilon": self.agent.epsilon_greedy_param if self.agent.epsilon_schedule else None,
+            "alpha": self.agent.alpha,
+            "steps_per_second": length / seconds if seconds > 0 else 0.0
+        }
+
+    def learn(
+        self,
+        show_q_table = True,
+        checkpoint_path: str | None = None,
+        resume = False,
+        checkpoint_every = CHECKPOINT_EVERY,
+        max_steps = MAX_STEPS,
+        telemetry: list[Telemetry] | None = None
+    ) -> int:
+        if resume and checkpoint_path and os.path.exists(checkpoint_path):
+            self.load_checkpoint(checkpoint_path)
+            print(f"Resuming from episode {self.episode}")
+        else:
+            self.has_won = False
+            self.episode = 0
+            self.steps = 0
+        telemetry = telemetry or []
+
+        steps = self.first_step = self.steps
+        start_time = episode_start_time = perf_counter()
+        episode_start_step = steps
+        episode_return = dq_sum = 0.0
+        s, _ = self.env.reset()
+        self.converged = False
+        try:
+            for steps in range(self.steps, max_steps): # take no more than max_steps steps in case it doesn't converge in time
+                a = self.agent.act(s)
+                prev_s = s
+
+                s, r, terminated, truncated, _ = self.env.step(a)
+                dq_sum += self.compute_q(prev_s, a, float(r), s)
+                episode_return += float(r)
+                self.agent.step_schedules("step")
+                steps += 1
+
+                if terminated or truncated:
+                    self.agent.step_schedules("episode") # i.e. anneal alpha
+
+                    if float(r) > 0:
+                        self.has_won = True
+                    self.policy_delta = None
+                    converged = self.test_convergence()
+
+                    if telemetry:
+                        now = perf_counter()
+                        record = self._episode_record(episode_return, steps - episode_start_step, float(r) > 0, dq_sum, now - episode_start_time)
+                        for sink in telemetry:
+                            sink.record(record)
+                        episode_start_time = now
+                    episode_start_step = steps
+                    episode_return = dq_sum = 0.0
+
+                    if converged:
+                        self.converged = True
+                        break
+
+                    self.episode += 1
+                    if checkpoint_path and self.episode % checkpoint_every == 0:
+                        self.steps = steps
+                        self.save_checkpoint(checkpoint_path)
+                    s, _ = self.env.reset()
+        finally: # still write out whatever's buffered if learning gets interrupted
+            for sink in telemetry:
+                sink.flush()
         
-        print(f"Converged after {self.episode} episodes taking {steps} steps")
+        self.steps = steps
+        self.report = self.memory_report(perf_counter() - start_time)
+        if self.converged:
+            print(f"Converged after {self.episode} episodes taking {steps} steps")
+        else:
+            print(f"Stopped without converging after {self.episode} episodes, having used all {steps} steps")
+        print(f"{self.report['steps_per_second']:.0f} steps/s, Q-table {self.report['q_table_bytes'] / 1024:.1f} KiB, map {self.report['map_bytes'] / 1024:.1f} KiB, {self.report['state_count_entries']} state counts")
         if show_q_table:
             self.agent.show_q_table()
         
         return self.episode
 
-def learn(
+# builds the map, environment, agent and learning environment for one run
+# shared by learn and batch.learn_batch so a batched map is set up exactly like a single run would be
+def make_learning_environment(
     size: int,
     success_rate: float,
-    alpha: float,
+    alpha: float | Schedule,
     gamma: float,
     exploration: Exploration,
     convergence_criteria: ConvergenceCriteria,
-    reward_schedule: tuple[float, float, float] = (10, -10, 0)
-):
+    reward_schedule: tuple[float, float, float],
+    map_seed: int,
+    env_seed: int,
+    agent_seed: int,
+    desc: list[str] | None = None
+) -> LearningEnvironment:
     global SIZE, IS_SLIPPERY
+    import gymnasium as gym
+    from gymnasium.envs.toy_text.frozen_lake import generate_random_map
 
     SIZE = size
     IS_SLIPPERY = False if success_rate == 1 else True
-    
+
     env = gym.make(
         "FrozenLake-v1",
         render_mode = None,
-        desc = generate_random_map(size = SIZE),
+        desc = desc or generate_random_map(size = SIZE, seed = map_seed),
         is_slippery = IS_SLIPPERY,
         success_rate = success_rate,
-        reward_schedule = reward_schedule
+        reward_schedule = reward_schedule,
+        max_episode_steps = max(100, 4 * SIZE) # the default 100 isn't enough to even reach the goal on really big maps
     )
-    agent = Agent(env, exploration, alpha, gamma)
-    learning_environment = LearningEnvironment(agent, convergence_criteria)
+    env.reset(seed = env_seed) # later resets keep using this seeded generator
+    # schedules keep their own state, so every run gets its own copies and the caller's are left alone for the next one
+    agent = Agent(env, copy.deepcopy(exploration), copy.deepcopy(alpha), gamma, agent_seed)
+    return LearningEnvironment(agent, convergence_criteria)
 
-    return learning_environment.learn(False)
+def learn(
+    size: int,
+    success_rate: float,
+    alpha: float | Schedule,
+    gamma: float,
+    exploration: Exploration,
+    convergence_criteria: ConvergenceCriteria,
+    reward_schedule: tuple[float, float, float] = (10, -10, 0),
+    checkpoint_path: str | None = None,
+    resume: bool = False,
+    checkpoint_every: int = CHECKPOINT_EVERY,
+    warm_start: str | None = None,
+    max_steps: int = MAX_STEPS,
+    telemetry: list[Telemetry] | None = None,
+    seed: int | None = None
+):
+    # the same seed gives the same map, the same slips and the same agent choices
+    seed, map_seed, env_seed, agent_seed = spawn_seeds(seed)
+    print(f"Seed: {seed}")
+
+    # resuming has to happen on the same map the checkpoint was taken on
+    desc = None
+    if resume and checkpoint_path and os.path.exists(checkpoint_path):
+        with np.load(checkpoint_path) as checkpoint:
+            desc = [row.tobytes().decode("utf-8") for row in checkpoint["desc"]]
+
+    learning_environment = make_learning_environment(
+        size, success_rate, alpha, gamma, exploration, convergence_criteria, reward_schedule, map_seed, env_seed, agent_seed, desc
+    )
+    if warm_start:
+        learning_environment.agent.warm_start(warm_start)
+
+    return learning_environment.learn(False, checkpoint_path, resume, checkpoint_every, max_steps = max_steps, telemetry = telemetry)
 
 def main():
     global SIZE, IS_SLIPPERY, RENDER_TO_SCREEN
+    import gymnasium as gym
+    from gymnasium.envs.toy_text.frozen_lake import generate_random_map
 
     # modify these lines below
     # or "import learn from qlearn" from a different python file
     SIZE = 8 # SIZE x SIZE map
     IS_SLIPPERY = True
     RENDER_TO_SCREEN = False
+    SEED = None # set to an int (or a previously printed seed) to replay a run exactly
+
+    seed, map_seed, env_seed, agent_seed = spawn_seeds(SEED)
+    print(f"Seed: {seed}")
 
     env = gym.make(
         "FrozenLake-v1",
         render_mode = "human" if RENDER_TO_SCREEN else None,
-        desc = generate_random_map(size = SIZE), # randomly generates a map
+        desc = generate_random_map(size = SIZE, seed = map_seed), # randomly generates a map
         #map_name = "4x4", # remember to change SIZE = 4
         #map_name = "8x8", # remember to change SIZE = 8
         is_slippery = IS_SLIPPERY,
         success_rate = 0.75,
         reward_schedule = (10, -10, 0)
     )
+    env.reset(seed = env_seed)
 
     """
     Exploration parameter values:
     ("epsilon_greedy", p) where p is the probability of taking a random action instead of following policy
     ("state_counting", k) where k is the state counting parameter; k = 1 works ok (for whatever reason)
+
+    epsilon (for epsilon_greedy) and alpha can also be Schedules instead of numbers, e.g.
+    ("epsilon_greedy", ExponentialSchedule(1, 0.999, minimum = 0.05)) or ("epsilon_greedy", GLIESchedule(100))
+    alpha = InverseTimeSchedule(0.5, 0.01) or alpha = VisitCountSchedule()
+    plain number alphas anneal by 0.9999 per episode on slippery maps (see legacy_alpha_schedule)
     """
 
-    agent = Agent(env, ("epsilon_greedy", 0.1), alpha = 0.05, gamma = 0.9)
-    #agent = Agent(env, ("state_counting", 1), alpha = 0.05 if IS_SLIPPERY else 1, gamma = 0.9)
+    agent = Agent(env, ("epsilon_greedy", 0.1), alpha = 0.05, gamma = 0.9, seed = agent_seed)
+    #agent = Agent(env, ("state_counting", 1), alpha = 0.05 if IS_SLIPPERY else 1, gamma = 0.9, seed = agent_seed)
         
     """
     ConvergenceCriteria parameter values:
     ("none", ...) doesn't check for criteria, instead taking the max number of steps every time
     ("policy_delta", n) checks for criteria if the policy doesn't change for at least n episodes; try n = 2
     ("v_delta", e) checks if the difference between every average Q value between two consecutive runs is less than some epsilon
+    ("success_rate", t) plays the greedy policy every 100 episodes (see evaluate.py) and checks if its success rate moved less than t
+    (or less than the width of its confidence interval) three times in a row, while staying above 0; try t = 0.01
     """
 
     #learning_environment = LearningEnvironment(agent, ("none", 0))
     learning_environment = LearningEnvironment(agent, ("policy_delta", 3))
     #learning_environment = LearningEnvironment(agent, ("v_delta", 0.0001)) # honestly just use policy_delta...
     learning_environment.learn(True)
+    #print(evaluate_policy(env.unwrapped.desc, agent.q_table, 0.75)) # how often the learned policy actually reaches the goal
+    #learning_environment.learn(True, telemetry = [JSONLTelemetry("episodes.jsonl")]) # per-episode metrics, needs "from telemetry import JSONLTelemetry"
 
 if __name__ == "__main__":
     main() # check out main to run this code by itself!
@@ -0,0 +1,84 @@
+# per-episode training records for LearningEnvironment.learn
+# records are buffered in memory and written out in bulk so the learning loop doesn't wait on disk
+
+import csv
+import json
+
+# every record has these keys, in this order (this is also the CSV header)
+TELEMETRY_FIELDS = [
+    "episode", # episode index
+    "return", # sum of rewards over the episode
+    "length", # steps taken in the episode
+    "won", # whether the episode ended on the goal
+    "mean_abs_dq", # mean |Q_new - Q_old| from compute_q over the episode
+    "policy_delta", # states whose greedy action changed, or None if it wasn't checked this episode
+    "epsilon", # current epsilon, or None if not using epsilon greedy
+    "alpha", # current alpha
+    "steps_per_second" # throughput over this episode
+]
+
+class Telemetry:
+    def __init__(self, buffer_size: int = 1_000):
+        self.buffer_size = buffer_size
+        self.buffer: list[dict] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def record(self, record: dict):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.write(self.buffer)
+            self.buffer = []
+
+    def write(self, records: list[dict]):
+        raise NotImplementedError("Telemetry.write has to be implemented by a subclass")
+
+    def close(self):
+        self.flush()
+
+# keeps every record in a list, handy for poking around in a notebook
+class MemoryTelemetry(Telemetry):
+    def __init__(self):
+        super().__init__(buffer_size = 1)
+        self.records: list[dict] = []
+
+    def write(self, records: list[dict]):
+        self.records.extend(records)
+
+# one JSON object per line
+class JSONLTelemetry(Telemetry):
+    def __init__(self, path: str, buffer_size: int = 1_000, append: bool = False):
+        super().__init__(buffer_size)
+        self.file = open(path, "a" if append else "w")
+
+    def write(self, records: list[dict]):
+        self.file.write("".join(json.dumps(record) + "\n" for record in records))
+        self.file.flush()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+class CSVTelemetry(Telemetry):
+    def __init__(self, path: str, buffer_size: int = 1_000, append: bool = False):
+        super().__init__(buffer_size)
+        self.file = open(path, "a" if append else "w", newline = "")
+        self.writer = csv.DictWriter(self.file, fieldnames = TELEMETRY_FIELDS)
+        if self.file.tell() == 0: # only write the header on a fresh file
+            self.writer.writeheader()
+
+    def write(self, records: list[dict]):
+        self.writer.writerows(records)
+        self.file.flush()
+
+    def close(self):
+        super().close()
+        self.file.close()
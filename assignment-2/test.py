@@ -1,9 +1,14 @@
-import matplotlib.pyplot as plt
+import subprocess
+import sys
+from time import perf_counter
+
 import numpy as np
 
-from qlearn import learn
+from qlearn import make_learning_environment, spawn_seeds
+from batch import learn_batch
 
 RUNS = 30
+SEED = 0 # run i uses seed SEED + i, so the episode counts are the same every time
 x = []
 
 SIZE = 4
@@ -12,16 +17,123 @@ SUCCESS_RATE = 0.75
 exploration = ("epsilon_greedy", 0.1)
 convergence_criteria = ("policy_delta", 3)
 
+# trains on a big generated map until its first win to make sure large maps stay practical and still get learned
+# the goal is a long way off on 64x64: over seeds 0-27 the first win took 1.38-1.88 million steps,
+# so the budget leaves plenty of room for any seed rather than depending on this one
+# run with "python test.py large"
+def large_map_test(size = 64, max_steps = 3_000_000, time_limit = 90):
+    start_time = perf_counter()
+    _, map_seed, env_seed, agent_seed = spawn_seeds(SEED)
+    learning_environment = make_learning_environment(
+        size, 1, 0.5, 0.9, exploration, convergence_criteria, (10, -1, -0.05), map_seed, env_seed, agent_seed
+    )
+    learning_environment.test_convergence = lambda: learning_environment.has_won # only the first win matters here
+    learning_environment.learn(False, max_steps = max_steps)
+    elapsed = perf_counter() - start_time
+    assert learning_environment.converged and learning_environment.has_won, f"never reached the goal in {max_steps} steps"
+    assert elapsed < time_limit, f"{size}x{size} map took {elapsed:.1f}s"
+    print(f"{size}x{size} map first reached the goal after {learning_environment.steps} steps, taking {elapsed:.1f}s")
+
+    # one byte per cell for the map, a dense float64 q table, and no state counts with epsilon greedy
+    report = learning_environment.report
+    assert report["states"] == size * size
+    assert report["map_bytes"] == size * size
+    assert report["q_table_bytes"] == size * size * 4 * 8
+    assert report["state_count_entries"] == 0
+    assert report["steps_per_second"] > 0
+
+# imports qlearn and trains a tiny map headlessly in a fresh interpreter, the way a sweep worker would,
+# and makes sure matplotlib never gets loaded and gymnasium only gets loaded once training starts
+# run with "python test.py startup"
+STARTUP_SCRIPT = """
+import sys
+from time import perf_counter
+start_time = perf_counter()
+import qlearn
+import_time = perf_counter() - start_time
+assert "matplotlib" not in sys.modules, "importing qlearn loaded matplotlib"
+assert "gymnasium" not in sys.modules, "importing qlearn loaded gymnasium"
+qlearn.learn(4, 1, 0.5, 0.9, ("epsilon_greedy", 0.1), ("none", 0), max_steps = 1_000, seed = 0)
+assert "matplotlib" not in sys.modules, "headless training loaded matplotlib"
+print(f"import qlearn took {import_time * 1000:.1f}ms")
+"""
+
+def startup_test(runs = 5):
+    start_time = perf_counter()
+    for _ in range(runs):
+        subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], check = True)
+    print(f"{(perf_counter() - start_time) / runs * 1000:.0f}ms per interpreter, from startup to trained")
+
+# rolls out a policy that's known to be safe on the classic 4x4 map a million times and checks it's quick and about right
+# run with "python test.py evaluate"
+def evaluate_test(episodes = 1_000_000, time_limit = 1):
+    from evaluate import evaluate_policy
+    desc = ["SFFF", "FHFH", "FFFH", "HFFG"]
+    policy = "2210" "1h1h" "221h" "h22g"
+    assert evaluate_policy(desc, policy, 1, 1_000, seed = SEED).success_rate == 1
+    start_time = perf_counter()
+    evaluation = evaluate_policy(desc, policy, SUCCESS_RATE, episodes, seed = SEED)
+    elapsed = perf_counter() - start_time
+    print(evaluation)
+    low, high = evaluation.interval
+    assert low <= evaluation.success_rate <= high
+    assert elapsed < time_limit, f"{episodes} rollouts took {elapsed:.2f}s"
+    print(f"{episodes} rollouts took {elapsed:.2f}s")
+
+# the success_rate criteria used to stop on any steady success rate, including a steady 0
+# seed 3 on an 8x8 slippery map is one that stopped at episode 600 with a success rate of 0
+def success_rate_convergence_test(seed = 3):
+    from evaluate import evaluate_policy
+    _, map_seed, env_seed, agent_seed = spawn_seeds(seed)
+    learning_environment = make_learning_environment(
+        8, SUCCESS_RATE, 0.05, 0.9, exploration, ("success_rate", 0.01), (10, -1, -0.05), map_seed, env_seed, agent_seed
+    )
+    episodes = learning_environment.learn(False)
+    evaluation = evaluate_policy(learning_environment.env.unwrapped.desc, learning_environment.agent.q_table, SUCCESS_RATE, seed = SEED) # pyright: ignore[reportAttributeAccessIssue]
+    print(f"success_rate converged after {episodes} episodes: {evaluation}")
+    assert evaluation.success_rate > 0
+
+# the same seed has to give the same run even when it's handed the same (stateful) schedule objects again
+# run with "python test.py schedules"
+def schedule_replay_test(seed = 1):
+    from qlearn import learn, ExponentialSchedule, LinearSchedule
+    epsilon = ExponentialSchedule(1, 0.99, minimum = 0.05)
+    runs = [learn(SIZE, SUCCESS_RATE, 0.05, 0.9, ("epsilon_greedy", epsilon), convergence_criteria, (10, -1, -0.05), seed = seed) for _ in range(2)]
+    assert runs[0] == runs[1], f"same seed took {runs[0]} and then {runs[1]} episodes"
+    assert epsilon.value == 1 and epsilon.t == 0 # the caller's schedule wasn't touched
+    batched = learn_batch([seed], SIZE, SUCCESS_RATE, 0.05, 0.9, ("epsilon_greedy", epsilon), convergence_criteria, (10, -1, -0.05))
+    assert batched == runs[:1]
+    try:
+        LinearSchedule(1, 0, steps = 0)
+        assert False
+    except ValueError:
+        pass
+
+if len(sys.argv) > 1 and sys.argv[1] == "large":
+    large_map_test()
+    sys.exit()
+if len(sys.argv) > 1 and sys.argv[1] == "evaluate":
+    evaluate_test()
+    success_rate_convergence_test()
+    sys.exit()
+if len(sys.argv) > 1 and sys.argv[1] == "schedules":
+    schedule_replay_test()
+    sys.exit()
+if len(sys.argv) > 1 and sys.argv[1] == "startup":
+    startup_test()
+    sys.exit()
+
 if len(x) == 0:
-    for _ in range(RUNS):
-        episode_count = learn(SIZE, SUCCESS_RATE, 0.05, 0.9, exploration, convergence_criteria, (10, -1, -0.05))
-        x.append(episode_count)
+    # every run at once, each one with the same episode count it would get from learn(..., seed = SEED + run)
+    x = learn_batch([SEED + run for run in range(RUNS)], SIZE, SUCCESS_RATE, 0.05, 0.9, exploration, convergence_criteria, (10, -1, -0.05))
 
 print(x)
 print(np.mean(x))
 print(np.std(x))
 
 """
+import matplotlib.pyplot as plt
+
 fig, ax = plt.subplots()
 ax.boxplot([x_0_9, x_0_8, x_0_7, x_0_6])
 ax.set_xticklabels(["0.9", "0.8", "0.7", "0.6"])